@@ -92,6 +92,7 @@ class AortaFramework(QMainWindow,Ui_MainWindow):
         self.segmentation_module.data_modified.connect(self.changesMade)
         self.segmentation_module.new_segmentation.connect(self.newSegmentation)
         self.segmentation_module.new_models.connect(self.newModels)
+        self.segmentation_module.save_resumed.connect(self.saveAndPropagate)
         self.centerline_module.data_modified.connect(self.changesMade)
         self.centerline_module.new_centerlines.connect(self.newCenterlines)
         self.metrics_module.metrics_changed.connect(self.changesMade)
@@ -0,0 +1,96 @@
+import copy
+import os
+import sys
+import tempfile
+import time
+
+import torch
+
+# internal imports
+from modules.Predictor import SegmentationPredictor
+from modules.Runet import GroupNormLeakyReLU, fuse_for_inference
+from benchmarks.inference import random_weights
+
+# compares RUNet with fused GroupNorm + LeakyReLU (fuse_for_inference) with the unfused network (output difference, time):
+# python -m benchmarks.fusion [size] [repeats]  (exit code 1 if outputs differ by more than MAX_DIFFERENCE)
+
+MAX_DIFFERENCE = 1e-3  # float32 rounding of the normalization statistics, amplified by deeper GroupNorms (as in benchmarks.tiling)
+
+
+def best_times(models, input_tc, repeats):
+    # runs of the models are interleaved in rotating order (load changes of the machine affect all of them), fastest run per model
+    times, outputs = {name: [] for name in models}, {}
+    names = list(models)
+    for r in range(repeats):
+        for name in names[r % len(names):] + names[:r % len(names)]:
+            model, compiled = models[name]
+            GroupNormLeakyReLU.compiled = compiled
+            start = time.perf_counter()
+            outputs[name] = model(input_tc)
+            times[name].append(time.perf_counter() - start)
+    return {name: min(t) for name, t in times.items()}, outputs
+
+
+def norm_activation_times(fused, input_tc, repeats):
+    # time of all GroupNorm + LeakyReLU applications of one forward pass, native kernels against the compiled kernel
+    # (isolates the fused operations from the convolutions)
+    calls = []
+    hooks = [m.register_forward_pre_hook(lambda module, args: calls.append((module, args[0].clone())))
+             for m in fused.modules() if isinstance(m, GroupNormLeakyReLU)]
+    GroupNormLeakyReLU.compiled = False
+    fused(input_tc)
+    for hook in hooks:
+        hook.remove()
+    times = {True: [], False: []}
+    for r in range(repeats):
+        for compiled in ((True, False) if r % 2 else (False, True)):
+            GroupNormLeakyReLU.compiled = compiled
+            inputs = [x.clone() for _, x in calls]
+            start = time.perf_counter()
+            for (module, _), x in zip(calls, inputs):
+                module(x)
+            times[compiled].append(time.perf_counter() - start)
+            del inputs
+    return min(times[False]), min(times[True])
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    predictor = SegmentationPredictor()
+    predictor.device = 'cpu'
+    predictor.fuse_norm_activation = False
+    if not os.path.exists(predictor.weights_file):
+        predictor.weights_file = os.path.join(tempfile.mkdtemp(), "random_weights")
+        random_weights(predictor.weights_file, predictor)
+        print("No trained weights found, using random weights")
+    model = predictor.load_model()
+    fused = fuse_for_inference(copy.deepcopy(model))
+    print("%d GroupNorm/LeakyReLU pairs fused" % sum(isinstance(m, GroupNormLeakyReLU) for m in fused.modules()))
+
+    torch.manual_seed(0)
+    input_tc = torch.rand((1, 1, size, size, size))
+    failed = False
+    with torch.set_grad_enabled(False):
+        start = time.perf_counter()
+        fused(torch.rand((1, 1, 64, 64, 128)))  # compiles the kernel (cached by torch for later processes)
+        print("first fused call (compilation) %.1fs" % (time.perf_counter() - start))
+        models = {'unfused': (model, None)}
+        if GroupNormLeakyReLU.compiled is False:
+            print("compiled kernel not available on this machine")
+        else:
+            models['compiled'] = (fused, True)
+        models['fallback'] = (fused, False)  # group_norm + leaky_relu_ in the fused modules
+        if 'compiled' in models:
+            native, compiled = norm_activation_times(fused, input_tc, repeats)
+            print("GroupNorm+LeakyReLU of one pass %d^3: native %.3fs, compiled %.3fs (%+.1f%%)" % (size, native, compiled, 100 * (compiled / native - 1)))
+        times, outputs = best_times(models, input_tc, repeats)
+        print("unfused          %d^3: %.2fs" % (size, times['unfused']))
+        for name in list(models)[1:]:
+            difference = (outputs[name] - outputs['unfused']).abs().max().item()
+            changed = ((outputs[name] > 0.5) != (outputs['unfused'] > 0.5)).sum().item()
+            ok = difference <= MAX_DIFFERENCE
+            failed |= not ok
+            print("fused %-10s %d^3: %.2fs (%+.1f%%), max difference %.1e, %d voxels changed at 0.5 %s"
+                  % (name, size, times[name], 100 * (times[name] / times['unfused'] - 1), difference, changed, "ok" if ok else "FAILED"))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+import torch
+
+# internal imports
+from modules.Predictor import SegmentationPredictor
+
+# headless speed benchmark of SegmentationPredictor on synthetic CT-like volumes, all inference modes and backends:
+# python -m benchmarks.inference [--sizes small medium] [--configs whole sliding_window] [--output results.json] [--baseline baseline.json]
+# without the trained weights (best_model497) the network is benchmarked with seeded random weights (same architecture and cost)
+
+SIZES = {
+    'small': (256, 256, 160),   # cropped abdomen, thick slices
+    'medium': (512, 512, 300),  # thorax
+    'large': (512, 512, 600),   # thorax-abdomen
+}
+
+CONFIGS = {
+    'whole': {},
+    'whole_compiled': {'use_compiled_model': True},
+    'whole_bfloat16': {'precision': 'bfloat16'},
+    'whole_int8': {'backend': 'int8'},
+    'whole_onnx': {'backend': 'onnx'},
+    'whole_tiled': {'tile_size': 32},
+    'sliding_window': {'inference_mode': 'sliding_window'},
+    'coarse_to_fine': {'inference_mode': 'coarse_to_fine'},
+    'parallel': {'inference_mode': 'parallel'},
+    'parallel_compiled': {'inference_mode': 'parallel', 'use_compiled_model': True},  # workers compile their own replica
+}
+
+
+def synthetic_volume(shape, seed=0):
+    # int16 HU volume (x, y, z) like a contrast enhanced CTA: body, lungs (upper half), spine, ascending/descending aorta
+    rng = np.random.default_rng(seed)
+    volume = np.empty(shape, dtype=np.int16)
+    x, y = np.ogrid[:shape[0], :shape[1]]
+    x = (x - shape[0] / 2) / shape[0]
+    y = (y - shape[1] / 2) / shape[1]
+    body = (x / 0.42)**2 + (y / 0.32)**2 < 1
+    spine = (x**2 + (y - 0.2)**2) < 0.035**2
+    for z in range(shape[2]):
+        t = z / shape[2]
+        thorax = t > 0.5
+        image = np.full(shape[:2], -1000, dtype=np.float32)
+        image[body] = 40
+        if thorax:
+            image[((np.abs(x) - 0.2) / 0.14)**2 + (y / 0.22)**2 < 1] = -850
+        image[spine] = 700
+        radius = 0.025 + 0.01 * t
+        image[((x + 0.04 + 0.01 * np.sin(6 * t))**2 + (y - 0.12)**2) < radius**2] = 300  # descending aorta
+        if thorax:
+            image[((x - 0.02)**2 + (y + 0.05)**2) < (radius * 1.2)**2] = 300  # ascending aorta
+        image += rng.normal(0, 25, shape[:2]).astype(np.float32)
+        volume[:, :, z] = image
+    return volume
+
+
+def random_weights(path, predictor, seed=0):
+    # seeded RUNet initialization stored like the trained checkpoint
+    torch.manual_seed(seed)
+    torch.save({'model_state_dict': predictor.build_network().state_dict()}, path)
+
+
+def make_predictor(weights_file, settings, args):
+    predictor = SegmentationPredictor()
+    predictor.progress = types.SimpleNamespace(emit=lambda value, msg: None)  # no Qt worker attached
+    predictor.result = types.SimpleNamespace(emit=lambda prediction: None)
+    predictor.device = args.device
+    predictor.weights_file = weights_file
+    predictor.quantized_weights_file = os.path.join(args.work_dir, os.path.basename(weights_file) + "_int8") if args.work_dir else weights_file + "_int8"
+    predictor.cache = None
+    predictor.inference_server = None  # measure in-process inference
+    if args.output_size:
+        predictor.output_size = tuple(args.output_size)
+    for name, value in settings.items():
+        setattr(predictor, name, value)
+    return predictor
+
+
+def prepare_backend(settings, weights_file, volume, args):
+    # create INT8 weights / ONNX exports needed by a configuration if they do not exist yet
+    if settings.get('backend') == 'int8':
+        from modules.Quantization import calibration_input, quantize_model
+        float_predictor = make_predictor(weights_file, {}, args)
+        float_predictor.device = 'cpu'
+        path = make_predictor(weights_file, settings, args).quantized_weights_file
+        if not os.path.exists(path):
+            model = quantize_model(float_predictor.load_model(), [calibration_input(float_predictor, volume)])
+            torch.save(model.state_dict(), path)
+    if settings.get('backend') == 'onnx':
+        from modules.OnnxBackend import export_onnx, onnx_model_path
+        float_predictor = make_predictor(weights_file, {}, args)
+        float_predictor.device = 'cpu'
+        for shape in (float_predictor.output_size, float_predictor.patch_size):
+            path = onnx_model_path(weights_file, shape)
+            if not os.path.exists(path):
+                export_onnx(float_predictor.load_model(), path, shape)
+
+
+def run_config(name, settings, weights_file, volume, args):
+    prepare_backend(settings, weights_file, volume, args)
+    predictor = make_predictor(weights_file, settings, args)
+    start = time.perf_counter()
+    predictor.load_model()
+    entry = {'config': name, 'settings': settings, 'load_time': time.perf_counter() - start}
+    try:
+        if args.warmup:
+            start = time.perf_counter()
+            predictor.predict(volume)  # includes one-time costs (tracing, kernel selection, sessions, worker processes)
+            entry['first_time'] = time.perf_counter() - start
+        best = None
+        for _ in range(args.repeats):
+            predictor.predict(volume)
+            record = predictor.instrumentation.last_record
+            if best is None or record['wall_time'] < best['wall_time']:
+                best = record
+    finally:
+        if predictor.parallel_pool is not None:
+            predictor.parallel_pool.close()  # peak RSS of 'parallel' is that of the parent process, workers are not included
+    entry['time'] = best['wall_time']
+    entry['cpu_time'] = best['cpu_time']
+    entry['peak_rss'] = best.get('peak_rss')
+    entry['stages'] = {s['name']: s['wall_time'] for s in best['stages']}
+    if predictor.inference_mode == 'coarse_to_fine':
+        entry['roi_fraction'] = predictor.report.get('roi_fraction')
+    return entry
+
+
+def regressions(results, baseline, tolerance):
+    # entries slower (or using more memory) than the baseline by more than tolerance
+    reference = {(r['config'], r['size']): r for r in baseline['results'] if 'time' in r}
+    found = []
+    for result in results:
+        base = reference.get((result['config'], result['size']))
+        if base is None or 'time' not in result:
+            continue
+        if result['time'] > base['time'] * (1 + tolerance):
+            found.append("%s@%s time %.2fs -> %.2fs" % (result['config'], result['size'], base['time'], result['time']))
+        if result.get('peak_rss') and base.get('peak_rss') and result['peak_rss'] > base['peak_rss'] * (1 + tolerance):
+            found.append("%s@%s peak RSS %.2fGB -> %.2fGB" % (result['config'], result['size'], base['peak_rss'] / 1024**3, result['peak_rss'] / 1024**3))
+    return found
+
+
+def environment(weights):
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpu = next(line.split(":", 1)[1].strip() for line in f if line.startswith("model name"))
+    except (OSError, StopIteration):
+        pass
+    return {'host': platform.node(), 'platform': platform.platform(), 'cpu': cpu, 'cpu_count': os.cpu_count(), 'torch_version': torch.__version__,
+            'num_threads': torch.get_num_threads(), 'cuda': torch.cuda.is_available(), 'weights': weights, 'timestamp': time.time()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark CNN inference on synthetic volumes")
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES), choices=list(SIZES))
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument("--repeats", type=int, default=1, help="timed predictions per configuration (fastest is reported)")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false", help="skip the untimed first prediction")
+    parser.add_argument("--device", default='cpu')
+    parser.add_argument("--output-size", nargs=3, type=int, default=None, help="model input size of whole volume prediction (default: predictor setting)")
+    parser.add_argument("--weights", default=None, help="trained weights (default: predictor setting, random weights if missing)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of random weights and synthetic volumes")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=None, help="results of an earlier run, exit code 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown/memory growth against the baseline")
+    args = parser.parse_args()
+
+    args.work_dir = None
+    weights_file = args.weights if args.weights else SegmentationPredictor().weights_file
+    weights = os.path.basename(weights_file)
+    if not os.path.exists(weights_file):
+        # derived artifacts (INT8 weights, ONNX exports) of random weights are kept next to them
+        args.work_dir = os.path.join(tempfile.gettempdir(), "aortaanalyzer_benchmark")
+        os.makedirs(args.work_dir, exist_ok=True)
+        weights_file = os.path.join(args.work_dir, "random_weights_seed%d" % args.seed)
+        if not os.path.exists(weights_file):
+            random_weights(weights_file, SegmentationPredictor(), args.seed)
+        weights = "random (seed %d)" % args.seed
+        print("No trained weights found, benchmarking with", weights)
+
+    results = []
+    for size in args.sizes:
+        volume = synthetic_volume(SIZES[size], args.seed)
+        for name in args.configs:
+            print("%-16s %-7s %s ..." % (name, size, "x".join([str(s) for s in SIZES[size]])), end=" ", flush=True)
+            try:
+                entry = run_config(name, CONFIGS[name], weights_file, volume, args)
+                print("%.2fs" % entry['time'] + (", peak RSS %.2fGB" % (entry['peak_rss'] / 1024**3) if entry['peak_rss'] else ""))
+            except Exception as e:  # unsupported configuration on this machine (e.g. missing onnxruntime), keep benchmarking the others
+                entry = {'config': name, 'settings': CONFIGS[name], 'error': repr(e)}
+                print("failed:", repr(e))
+            entry['size'] = size
+            entry['shape'] = list(SIZES[size])
+            results.append(entry)
+        del volume
+
+    report = {'environment': environment(weights), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print("REGRESSION", line)
+        if found:
+            sys.exit(1)
+        print("No regressions against", args.baseline)
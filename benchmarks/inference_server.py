@@ -0,0 +1,91 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+# internal imports
+from modules.Predictor import SegmentationPredictor
+from benchmarks.inference import make_predictor, random_weights, synthetic_volume
+
+# predictions of a local inference server (python -m modules.InferenceServer) against in-process predictions, and the order
+# in which the server finishes the cases of a client submitting several cases and a client submitting one case later:
+# python -m benchmarks.inference_server --shape 256 256 160 --cases 3  (exit code 1 if masks differ or the later client waits
+# for all cases of the first)
+
+
+def start_server(address, weights_file):
+    server = subprocess.Popen([sys.executable, "-m", "modules.InferenceServer", "--address", address, "--weights", weights_file])
+    client = SegmentationPredictor()
+    client.weights_file = weights_file
+    client.inference_server = address
+    while client.serverClient().status(client) is None:  # model loading and warm-up
+        if server.poll() is not None:
+            raise RuntimeError("Inference server did not start")
+        time.sleep(0.5)
+    return server
+
+
+def submit(predictor, name, volume, finished):
+    start = time.perf_counter()
+    predictor.predict(volume)
+    finished.append((name, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the local inference server against in-process inference")
+    parser.add_argument("--shape", nargs=3, type=int, default=[256, 256, 160])
+    parser.add_argument("--cases", type=int, default=3, help="cases submitted at once by the first client")
+    parser.add_argument("--output-size", nargs=3, type=int, default=None, help="model input size (default: predictor setting)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    args.device, args.work_dir = 'cpu', tempfile.mkdtemp()
+    weights_file = SegmentationPredictor().weights_file
+    if not os.path.exists(weights_file):
+        weights_file = os.path.join(args.work_dir, "random_weights")
+        random_weights(weights_file, SegmentationPredictor(), args.seed)
+        print("No trained weights found, using random weights")
+    address = os.path.join(args.work_dir, "inference.sock")
+    volumes = [np.asfortranarray(synthetic_volume(tuple(args.shape), args.seed + i)) for i in range(args.cases + 1)]  # Fortran ordered as VTK buffers
+
+    server = start_server(address, weights_file)
+    try:
+        local = make_predictor(weights_file, {}, args)
+        remote = make_predictor(weights_file, {'inference_server': address}, args)
+        failed = False
+        start = time.perf_counter()
+        reference = local.predict(volumes[0])
+        local_time = time.perf_counter() - start
+        start = time.perf_counter()
+        prediction = remote.predict(volumes[0])
+        remote_time = time.perf_counter() - start
+        changed = int(np.count_nonzero(prediction != reference))
+        failed |= changed != 0
+        print("in-process %.1fs, inference server %.1fs, %d voxels differ %s" % (local_time, remote_time, changed, "ok" if changed == 0 else "FAILED"))
+
+        # client A submits all its cases at once, client B one case while the first case of A is predicted
+        finished = []
+        client_a = make_predictor(weights_file, {'inference_server': address}, args)
+        client_b = make_predictor(weights_file, {'inference_server': address}, args)
+        threads = [threading.Thread(target=submit, args=(client_a, "A%d" % i, volumes[i], finished)) for i in range(args.cases)]
+        for thread in threads:
+            thread.start()
+        while client_a.serverClient().status(client_a) < args.cases and threads[-1].is_alive():  # one case of A predicted, the others queued
+            time.sleep(0.05)
+        threads.append(threading.Thread(target=submit, args=(client_b, "B", volumes[-1], finished)))
+        threads[-1].start()
+        for thread in threads:
+            thread.join()
+        order = [name for name, _ in finished]
+        ok = order.index("B") < len(order) - 1 or args.cases < 3  # with two cases the second of A is queued before B
+        failed |= not ok
+        print("finished: " + ", ".join("%s %.1fs" % f for f in finished) + " (B before the last case of A %s)" % ("ok" if ok else "FAILED"))
+    finally:
+        server.terminate()
+        server.wait()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,114 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+import torch
+
+# internal imports
+from modules.Predictor import SegmentationPredictor, dice_score
+from benchmarks.inference import random_weights
+
+# fixed model input size (output_size) against the adaptive grid from the physical extent of the scan (grid_spacing) for scan
+# types of different field of view and length: input size, mm per model voxel, forward time and the Dice of the aorta after the
+# round trip volume -> model grid -> volume (resolution loss of the grid, independent of the weights). With trained weights the
+# predictions are scored against the phantom aorta too:
+# python -m benchmarks.input_grid --scans thorax_small_fov thorax_abdomen runoff --grid-spacing 1.0
+# (exit code 1 if the adaptive grid keeps a round trip Dice below MIN_ROUND_TRIP_DICE or exceeds grid_max_voxels)
+
+SCANS = {  # shape, spacing (mm), grid spacing (mm, None: --grid-spacing)
+    'thorax_small_fov': ((512, 512, 200), (0.49, 0.49, 1.25), None),  # 250 mm field of view, 250 mm long
+    'thorax_abdomen': ((512, 512, 600), (0.78, 0.78, 1.0), None),     # 400 mm field of view, 600 mm long
+    'runoff': ((512, 512, 1250), (0.9, 0.9, 1.25), None),             # 460 mm field of view, 1.56 m long
+    'thorax_fine_grid': ((512, 512, 700), (0.68, 0.68, 0.5), 0.5),    # 350 mm field of view and length at 0.5 mm: all axes above grid_max_size
+}
+MIN_ROUND_TRIP_DICE = 0.9
+
+
+def phantom(shape, spacing, seed=0):
+    # int16 HU volume (x, y, z) and aorta mask with physical dimensions (z = 0 superior): body, aortic arch (in the y-z plane,
+    # z-resolution matters), ascending aorta and the descending aorta down the whole scan, 12 mm radius tapering towards the feet
+    rng = np.random.default_rng(seed)
+    volume = np.empty(shape, dtype=np.int16)
+    aorta = np.empty(shape, dtype=np.bool_)
+    x = (np.arange(shape[0]) - shape[0] / 2)[:, None] * spacing[0]  # mm from the center of the field of view
+    y = (np.arange(shape[1]) - shape[1] / 2)[None, :] * spacing[1]
+    body = (x / 170)**2 + (y / 120)**2 < 1
+    length = shape[2] * spacing[2]
+    arch_z, arch_radius = 50, 30  # center and radius of the arch centerline (mm)
+    for z in range(shape[2]):
+        position = z * spacing[2]
+        radius = 12 * (1 - 0.5 * position / length)
+        if position <= arch_z:
+            lumen = (np.sqrt(y**2 + (position - arch_z)**2) - arch_radius)**2 + (x + 20)**2 < radius**2
+        else:
+            lumen = (x + 20 + 10 * np.sin((position - arch_z) / 150))**2 + (y - arch_radius)**2 < radius**2  # descending
+            if position < arch_z + 100:
+                lumen |= (x + 20)**2 + (y + arch_radius)**2 < radius**2  # ascending
+        aorta[:, :, z] = lumen
+        image = np.full(shape[:2], -1000, dtype=np.float32)
+        image[body] = 40
+        image[lumen] = 300
+        image += rng.normal(0, 25, shape[:2]).astype(np.float32)
+        volume[:, :, z] = image
+    return volume, aorta
+
+
+def round_trip(predictor, mask, input_size):
+    # mask resampled to the model grid and back as a prediction with perfect probabilities would be
+    mask_tc = torch.from_numpy(mask).to(torch.float32).unsqueeze(0).unsqueeze(0)
+    grid_tc = predictor.resample(mask_tc, (1, 1, *input_size), 'cpu')
+    del mask_tc
+    return predictor.resample_threshold(grid_tc, (1, 1, *mask.shape), 'cpu')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the fixed and the adaptive CNN input grid across scan types")
+    parser.add_argument("--scans", nargs="+", default=list(SCANS), choices=list(SCANS))
+    parser.add_argument("--grid-spacing", type=float, default=1.0, help="mm per model input voxel of the adaptive grid")
+    parser.add_argument("--output-size", nargs=3, type=int, default=None, help="fixed input size (default: predictor setting)")
+    parser.add_argument("--no-forward", action="store_true", help="skip timing the forward passes (large inputs need much memory)")
+    args = parser.parse_args()
+
+    predictor = SegmentationPredictor()
+    predictor.progress = types.SimpleNamespace(emit=lambda value, msg: None)  # no Qt worker attached
+    predictor.device = 'cpu'
+    predictor.cache = None
+    predictor.inference_server = None
+    if args.output_size:
+        predictor.output_size = tuple(args.output_size)
+    trained = os.path.exists(predictor.weights_file)
+    if not trained:
+        predictor.weights_file = os.path.join(tempfile.mkdtemp(), "random_weights")
+        random_weights(predictor.weights_file, predictor)
+        print("No trained weights found, forward passes with random weights, no prediction scores")
+    failed = False
+    with torch.set_grad_enabled(False):
+        for name in args.scans:
+            shape, spacing, scan_grid_spacing = SCANS[name]
+            volume, aorta = phantom(shape, spacing)
+            print("%s: %s voxels, %s mm" % (name, "x".join([str(s) for s in shape]), "x".join(["%.0f" % (n * s) for n, s in zip(shape, spacing)])))
+            for grid, grid_spacing in (('fixed', None), ('adaptive', scan_grid_spacing or args.grid_spacing)):
+                predictor.grid_spacing = grid_spacing
+                input_size = predictor.input_size(shape, spacing)
+                model_spacing = [n * s / i for n, s, i in zip(shape, spacing, input_size)]
+                dice = dice_score(round_trip(predictor, aorta, input_size), aorta)
+                line = "  %-8s input %-11s %-17s round trip Dice %.4f" % (grid, "x".join([str(s) for s in input_size]),
+                                                                        "(%s mm)" % "x".join(["%.2f" % s for s in model_spacing]), dice)
+                if not args.no_forward:
+                    input_tc = torch.rand((1, 1, *input_size))
+                    start = time.perf_counter()
+                    predictor.forward(input_tc)
+                    line += ", forward %.1fs" % (time.perf_counter() - start)
+                    del input_tc
+                if trained:
+                    line += ", prediction Dice %.4f" % dice_score(predictor.predict(volume, spacing), aorta)
+                if grid == 'adaptive' and (dice < MIN_ROUND_TRIP_DICE or np.prod(input_size) > predictor.grid_max_voxels):
+                    failed = True
+                    line += " FAILED"
+                print(line)
+            del volume, aorta
+    sys.exit(1 if failed else 0)
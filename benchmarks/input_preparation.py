@@ -0,0 +1,84 @@
+import multiprocessing
+import sys
+import time
+import types
+
+import numpy as np
+import torch
+
+# internal imports
+from modules.Instrumentation import RSSSampler, current_rss
+from modules.Predictor import SegmentationPredictor
+from benchmarks.inference import synthetic_volume
+from benchmarks.resampling import grid_resample
+
+# peak memory and time of the CNN input preparation (display buffer -> normalized model input), former copying path
+# against the current one: python -m benchmarks.input_preparation [x y z]  (exit code 1 if the model inputs differ)
+
+MAX_DIFFERENCE = 1e-5
+
+
+def former_preparation(image_data, predictor):
+    # reference: copy in generateCNNSeg, transposing float copy, masked clamping, normalization and resampling with temporaries
+    volume = np.copy(image_data)
+    volume = volume.swapaxes(0, 1)
+    lw, uw = -700, 2300
+    volume_tc = torch.from_numpy(volume.astype(np.float32)).unsqueeze(0).unsqueeze(0)
+    if predictor.windowing:
+        volume_tc[volume_tc > uw] = uw
+        volume_tc[volume_tc < lw] = lw
+        volume_tc = volume_tc * (uw-lw)+lw
+    volume_tc = (volume_tc - torch.min(volume_tc)) / (torch.max(volume_tc) - torch.min(volume_tc))
+    return grid_resample(volume_tc, (1, 1, *predictor.output_size), 'cpu')
+
+
+def current_preparation(image_data, predictor):
+    volume = image_data.view()
+    volume.flags.writeable = False
+    volume_tc = predictor.load_volume(volume.swapaxes(0, 1))
+    return predictor.resample(volume_tc, (1, 1, *predictor.output_size), 'cpu')
+
+
+def prepare(implementation, shape, windowing, queue):
+    # runs in a fresh process, the display buffer is Fortran ordered like the VTK scalars in SegmentationModule
+    image_data = np.asfortranarray(synthetic_volume(shape))
+    predictor = SegmentationPredictor()
+    predictor.progress = types.SimpleNamespace(emit=lambda value, msg: None)
+    predictor.windowing = windowing
+    sampler = RSSSampler(0.002)
+    sampler.start()
+    baseline = current_rss()
+    start = time.perf_counter()
+    with torch.set_grad_enabled(False):
+        input_tc = (former_preparation if implementation == 'former' else current_preparation)(image_data, predictor)
+    duration = time.perf_counter() - start
+    sampler.stop()
+    queue.put((sampler.peak() - baseline, duration, input_tc[0, 0, ::8, ::8, ::8].numpy().copy()))
+
+
+def measure(implementation, shape, windowing):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=prepare, args=(implementation, shape, windowing, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    shape = tuple(int(s) for s in sys.argv[1:4]) if len(sys.argv) > 3 else (512, 512, 600)
+    volume_bytes = np.prod(shape) * 2
+    failed = False
+    for windowing in (False, True):
+        results = {}
+        for implementation in ('former', 'current'):
+            peak, duration, sample = measure(implementation, shape, windowing)
+            results[implementation] = sample
+            print("%-7s windowing=%-5s %s: peak %6.0f MB (%4.1fx int16 volume) %.2fs"
+                  % (implementation, windowing, "x".join([str(s) for s in shape]), peak / 1024**2, peak / volume_bytes, duration))
+        difference = float(np.abs(results['former'] - results['current']).max())
+        ok = difference <= MAX_DIFFERENCE
+        failed |= not ok
+        print("  max difference of model inputs %.1e %s" % (difference, "ok" if ok else "FAILED"))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,71 @@
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+import torch
+
+# internal imports
+from modules.Instrumentation import RSSSampler, current_rss
+from modules.Predictor import SegmentationPredictor
+
+# back-projection of the network output: former resample + threshold of the full size tensor against the slab-wise
+# SegmentationPredictor.resample_threshold (identical masks, peak memory, time):
+# python -m benchmarks.output_resampling  (exit code 1 if a mask differs)
+
+CASES = [
+    ((1, 1, 96, 96, 96), (1, 1, 200, 180, 150)),  # quick check, growing and shrinking axes
+    ((1, 1, 64, 64, 64), (1, 1, 50, 90, 41)),
+    ((1, 1, 400, 400, 400), (1, 1, 512, 512, 600)),  # whole volume inference of a thorax-abdomen scan
+]
+
+
+def probability_map(shape, seed=0):
+    # smooth map with large regions close to the threshold
+    torch.manual_seed(seed)
+    coarse = torch.rand((1, 1, *[max(2, s // 16) for s in shape[2:]]))
+    return SegmentationPredictor().resample(coarse, shape, 'cpu')
+
+
+def threshold(implementation, shape, new_size, queue):
+    # runs in a fresh process -> peak RSS only covers the back-projection of the probability map
+    predictor = SegmentationPredictor()
+    output_tc = probability_map(shape)
+    sampler = RSSSampler(0.002)
+    sampler.start()
+    baseline = current_rss()
+    start = time.perf_counter()
+    with torch.set_grad_enabled(False):
+        if implementation == 'former':
+            prediction = (predictor.resample(output_tc, new_size, 'cpu')[0, 0] > 0.5).numpy()
+        else:
+            prediction = predictor.resample_threshold(output_tc, new_size, 'cpu')
+    duration = time.perf_counter() - start
+    sampler.stop()
+    queue.put((sampler.peak() - baseline, duration, np.packbits(prediction)))
+
+
+def measure(implementation, shape, new_size):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=threshold, args=(implementation, shape, new_size, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    cases = CASES if len(sys.argv) < 2 else [case for case in CASES if "x".join([str(s) for s in case[1][2:]]) in sys.argv[1:]]
+    failed = False
+    for shape, new_size in cases:
+        results = {}
+        for implementation in ('former', 'slabs'):
+            peak, duration, packed = measure(implementation, shape, new_size)
+            results[implementation] = packed
+            print("%-6s %s -> %s: peak %6.0f MB %.2fs" % (implementation, "x".join([str(s) for s in shape[2:]]), "x".join([str(s) for s in new_size[2:]]),
+                                                       peak / 1024**2, duration))
+        changed = int(np.count_nonzero(np.unpackbits(results['former']) != np.unpackbits(results['slabs'])))
+        failed |= changed != 0
+        print("  %d voxels differ %s" % (changed, "ok" if changed == 0 else "FAILED"))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,64 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# internal imports
+from modules.Predictor import SegmentationPredictor
+from modules.ThreadTuner import available_cpus
+from benchmarks.inference import make_predictor, random_weights, synthetic_volume
+
+# sliding window prediction of one case in one process (all threads) against inference_mode 'parallel' with worker pools:
+# python -m benchmarks.parallel --shape 512 512 300 --threads 4 8  (exit code 1 if the masks differ)
+
+
+def timed_predict(predictor, volume, repeats):
+    predictor.predict(volume)  # model loading, worker start and one-time initialization
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        prediction = predictor.predict(volume)
+        times.append(time.perf_counter() - start)
+    return min(times), prediction
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare single process and multi-process sliding window inference")
+    parser.add_argument("--shape", nargs=3, type=int, default=[512, 512, 300])
+    parser.add_argument("--patch-size", nargs=3, type=int, default=None, help="window size (default: predictor setting)")
+    parser.add_argument("--threads", nargs="+", type=int, default=[2, 4, 8], help="torch threads per worker process to try")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    args.device, args.output_size, args.work_dir = 'cpu', None, None
+    weights_file = SegmentationPredictor().weights_file
+    if not os.path.exists(weights_file):
+        weights_file = os.path.join(tempfile.mkdtemp(), "random_weights")
+        random_weights(weights_file, SegmentationPredictor(), args.seed)
+        print("No trained weights found, using random weights")
+    volume = synthetic_volume(tuple(args.shape), args.seed)
+    settings = {'inference_mode': 'sliding_window'}
+    if args.patch_size:
+        settings['patch_size'] = tuple(args.patch_size)
+    cpus = len(available_cpus())
+
+    predictor = make_predictor(weights_file, settings, args)
+    reference_time, reference = timed_predict(predictor, volume, args.repeats)
+    print("single process    %2d threads: %.1fs" % (predictor.thread_config['num_threads'] if predictor.thread_config else cpus, reference_time))
+    failed = False
+    for threads in args.threads:
+        workers = max(1, cpus // threads)
+        predictor = make_predictor(weights_file, dict(settings, inference_mode='parallel', parallel_threads=threads), args)
+        try:
+            duration, prediction = timed_predict(predictor, volume, args.repeats)
+        finally:
+            predictor.parallel_pool.close()
+        changed = int(np.count_nonzero(prediction != reference))
+        ok = changed == 0
+        failed |= not ok
+        print("%2d workers x %2d threads: %.1fs (speedup %.2f), %d voxels differ %s" % (workers, threads, duration, reference_time / duration, changed, "ok" if ok else "FAILED"))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,56 @@
+import sys
+import time
+
+import numpy as np
+from skimage import morphology
+
+# internal imports
+from modules.Predictor import remove_small_clusters
+from defaults import MIN_CLUSTER_SIZE
+
+# compares the small cluster removal of the prediction postprocessing with the former per-label loop on a noisy mask:
+# python -m benchmarks.postprocessing  (exit code 1 if the outputs differ)
+
+
+def loop_remove_small_clusters(mask, min_size):
+    # reference: former per-label implementation in SegmentationPredictor.__postprocess
+    mask = mask.copy()
+    label_img = morphology.label(mask, connectivity=2)
+    label_hist, _ = np.histogram(label_img, bins=np.max(label_img)+1)
+    for i in range(1, len(label_hist)):
+        cluster_size = label_hist[i]
+        if 0 < cluster_size < min_size:
+            mask[label_img==i] = 0
+    return mask
+
+
+def noisy_mask(shape, seed=0):
+    # large tube (kept) plus a few hundred small blobs and speckle noise (removed)
+    rng = np.random.default_rng(seed)
+    _, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[:] = (y - shape[1] / 2)**2 + (x - shape[2] / 2)**2 < (shape[1] / 8)**2
+    for _ in range(300):
+        center = [rng.integers(0, s) for s in shape]
+        radius = rng.integers(1, 8)
+        region = tuple(slice(max(0, c - radius), c + radius) for c in center)
+        mask[region] = 1
+    mask[rng.random(shape) < 0.001] = 1
+    return mask
+
+
+if __name__ == "__main__":
+    failed = False
+    for shape in [(96, 96, 96), (160, 160, 160)]:
+        mask = noisy_mask(shape)
+        components = morphology.label(mask, connectivity=2).max()
+        start = time.perf_counter()
+        expected = loop_remove_small_clusters(mask, MIN_CLUSTER_SIZE)
+        loop_time = time.perf_counter() - start
+        start = time.perf_counter()
+        filtered = remove_small_clusters(mask, MIN_CLUSTER_SIZE)
+        lookup_time = time.perf_counter() - start
+        identical = filtered.dtype == expected.dtype and np.array_equal(filtered, expected)
+        failed |= not identical
+        print("%s %d components: loop %.2fs, lookup %.2fs (%.0fx) %s" % (list(shape), components, loop_time, lookup_time, loop_time / lookup_time, "identical" if identical else "DIFFERENT"))
+    sys.exit(1 if failed else 0)
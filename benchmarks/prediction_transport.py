@@ -0,0 +1,47 @@
+import sys
+import time
+
+import numpy as np
+
+# internal imports
+from modules.Predictor import crop_prediction, paste_prediction
+from benchmarks.inference import synthetic_volume
+
+# GUI thread time to take over a CNN prediction, former full size transport against the bounding box crop:
+# python -m benchmarks.prediction_transport [x y z]  (exit code 1 if the label maps differ)
+
+
+def former_transport(prediction, label_map_data):
+    # copy into the (C ordered) label buffer and into a new Fortran ordered VTK array
+    x0, y0, z0 = prediction.shape
+    label_map_data[:x0, :y0, :z0] = prediction
+    return label_map_data.ravel(order='F')
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    shape = tuple(int(s) for s in sys.argv[1:4]) if len(sys.argv) > 3 else (512, 512, 600)
+    volume = synthetic_volume(shape)
+    prediction = (volume > 200) & (volume < 450)  # contrast enhanced aorta
+    del volume
+
+    label_map_c = np.zeros(shape, dtype=np.uint8)
+    vtk_buffer, former_time = timed(former_transport, prediction, label_map_c)
+    print("former          %s: GUI %.3fs, transported %6.1f MB" % ("x".join([str(s) for s in shape]), former_time, prediction.nbytes / 1024**2))
+
+    failed = False
+    for pack in (False, True):
+        crop, crop_time = timed(crop_prediction, prediction, pack)
+        label_map_f = np.full(shape, 1, dtype=np.uint8, order='F')  # previous segmentation is overwritten
+        _, paste_time = timed(paste_prediction, crop, label_map_f)
+        ok = np.array_equal(label_map_f.ravel(order='F'), vtk_buffer)
+        failed |= not ok
+        print("crop packed=%-5s %s: GUI %.3fs (worker crop %.3fs), transported %6.1f MB, box %s %s"
+              % (pack, "x".join([str(s) for s in shape]), paste_time, crop_time, crop['data'].nbytes / 1024**2,
+                 "x".join([str(s) for s in crop['size']]), "ok" if ok else "FAILED"))
+    sys.exit(1 if failed else 0)
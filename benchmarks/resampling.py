@@ -0,0 +1,89 @@
+import multiprocessing
+import resource
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+# internal imports
+from modules.Predictor import SegmentationPredictor
+
+# compares SegmentationPredictor.resample with the former affine_grid/grid_sample implementation and checks peak memory:
+# python -m benchmarks.resampling  (exit code 1 on a mismatch or memory regression)
+
+MAX_DIFFERENCE = 1e-5  # same float32 sample positions, differences are rounding of the interpolation only
+MAX_PEAK_FACTOR = 1.5  # peak memory growth allowed on top of input + output tensor
+
+
+def grid_resample(tensor, new_size, device, mode='bilinear'):
+    # reference: former SegmentationPredictor.resample with an explicit sampling grid
+    identity_transform = torch.eye(len(new_size)-1, device=device)[:-1, :].unsqueeze(0)
+    identity_transform = torch.repeat_interleave(identity_transform, new_size[0], dim=0)
+    sampling_grid = F.affine_grid(identity_transform, new_size, align_corners=False)
+    return F.grid_sample(tensor, sampling_grid, mode=mode, padding_mode='zeros', align_corners=False)
+
+
+def compare(shape, new_size, mode):
+    tensor = torch.rand(shape)
+    with torch.set_grad_enabled(False):
+        expected = grid_resample(tensor, new_size, 'cpu', mode)
+        resampled = SegmentationPredictor().resample(tensor, new_size, 'cpu', mode)
+    if resampled.shape != expected.shape:
+        return float('inf')
+    return (resampled - expected).abs().max().item()
+
+
+def peak_memory(implementation, shape, new_size, queue):
+    # runs in a fresh process -> ru_maxrss only covers this resampling
+    tensor = torch.rand(shape)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    start = time.perf_counter()
+    with torch.set_grad_enabled(False):
+        if implementation == 'grid':
+            grid_resample(tensor, new_size, 'cpu')
+        else:
+            SegmentationPredictor().resample(tensor, new_size, 'cpu')
+    duration = time.perf_counter() - start
+    queue.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline, duration))
+
+
+def measure(implementation, shape, new_size):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=peak_memory, args=(implementation, shape, new_size, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    failed = False
+
+    print("Agreement with the sampling grid implementation")
+    for shape, new_size in [((1, 1, 96, 80, 120), (1, 1, 64, 64, 64)),
+                            ((1, 1, 64, 64, 64), (1, 1, 96, 80, 120)),
+                            ((1, 1, 50, 60, 70), (1, 1, 20, 33, 70)),
+                            ((2, 1, 9, 9, 9), (2, 1, 31, 5, 9))]:
+        for mode in ('bilinear', 'nearest'):
+            difference = compare(shape, new_size, mode)
+            ok = difference <= MAX_DIFFERENCE
+            failed |= not ok
+            print("  %s -> %s %-8s max difference %.2e %s" % (list(shape[2:]), list(new_size[2:]), mode, difference, "ok" if ok else "FAILED"))
+
+    print("Peak memory (model input and back-resampling)")
+    for shape, new_size in [((1, 1, 512, 512, 600), (1, 1, 256, 256, 256)),
+                            ((1, 1, 256, 256, 256), (1, 1, 512, 512, 600))]:
+        tensor_bytes = (torch.Size(shape).numel() + torch.Size(new_size).numel()) * 4
+        for implementation in ('grid', 'separable'):
+            peak, duration = measure(implementation, shape, new_size)
+            line = "  %-9s %s -> %s peak %6.0f MB (%.2fx input + output) %.2fs" % (implementation, list(shape[2:]), list(new_size[2:]), peak / 1024**2, peak / tensor_bytes, duration)
+            if implementation == 'separable':
+                ok = peak <= MAX_PEAK_FACTOR * tensor_bytes
+                failed |= not ok
+                line += " ok" if ok else " FAILED"
+            print(line)
+
+    sys.exit(1 if failed else 0)
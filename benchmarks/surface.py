@@ -0,0 +1,92 @@
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+import torch
+import skimage.measure as measure
+
+# internal imports
+from modules.Instrumentation import RSSSampler, current_rss
+from modules.Predictor import SegmentationPredictor, iso_surface
+
+# lumen surface of a network output: full resolution mask (resample_threshold) + marching cubes of the mask (as the
+# isosurface pipeline of the GUI) against iso_surface of the model resolution probability map (time, peak memory, volume):
+# python -m benchmarks.surface  (exit code 1 if the enclosed volumes differ by more than MAX_VOLUME_DIFFERENCE)
+
+CASES = [
+    ((1, 1, 128, 128, 128), (1, 1, 200, 180, 150)),  # quick check
+    ((1, 1, 400, 400, 400), (1, 1, 512, 512, 600)),  # whole volume inference of a thorax-abdomen scan
+]
+MAX_VOLUME_DIFFERENCE = 0.02  # relative, the mask only samples the level set of the probability map
+
+
+def probability_map(shape):
+    # aorta like tube along the last axis (curved centerline, varying radius), soft boundary of a few voxels
+    d, h, w = shape[2:]
+    x, y, z = np.meshgrid(np.arange(d), np.arange(h), np.arange(w), indexing='ij', sparse=True)
+    t = z / w
+    center_x = d * (0.5 + 0.15 * np.sin(2 * np.pi * t))
+    center_y = h * (0.45 + 0.1 * np.cos(3 * np.pi * t))
+    radius = d * (0.05 + 0.02 * t)
+    distance = np.sqrt((x - center_x)**2 + (y - center_y)**2)
+    probability = 1 / (1 + np.exp((distance - radius) / 1.5))
+    return torch.from_numpy(probability.astype(np.float32)).reshape(shape)
+
+
+def enclosed_volume(vertices, faces):
+    # signed volume (divergence theorem), positive for outward oriented faces
+    v0, v1, v2 = (vertices[faces[:, i]].astype(np.float64) for i in range(3))
+    return float(np.einsum('ij,ij->i', v0, np.cross(v1, v2)).sum() / 6)
+
+
+def surface(implementation, shape, new_size, queue):
+    # runs in a fresh process -> peak RSS only covers the surface extraction from the probability map
+    predictor = SegmentationPredictor()
+    output_tc = probability_map(shape)
+    sampler = RSSSampler(0.002)
+    sampler.start()
+    baseline = current_rss()
+    start = time.perf_counter()
+    with torch.set_grad_enabled(False):
+        if implementation == 'mask':
+            mask = predictor.resample_threshold(output_tc, new_size, 'cpu')
+            voxels = int(np.count_nonzero(mask))
+            vertices, faces, _, _ = measure.marching_cubes(np.pad(mask, 1), 0.5)  # padded as in the GUI
+            vertices -= 1
+            faces = faces[:, [0, 2, 1]]  # outwards as iso_surface
+        else:
+            vertices, faces = iso_surface(output_tc[0, 0].numpy(), new_size[2:])
+            voxels = None
+    duration = time.perf_counter() - start
+    sampler.stop()
+    queue.put((sampler.peak() - baseline, duration, len(vertices), enclosed_volume(vertices, faces), voxels))
+
+
+def measure_surface(implementation, shape, new_size):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=surface, args=(implementation, shape, new_size, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    cases = CASES if len(sys.argv) < 2 else [case for case in CASES if "x".join([str(s) for s in case[1][2:]]) in sys.argv[1:]]
+    failed = False
+    for shape, new_size in cases:
+        volumes = {}
+        for implementation in ('mask', 'low_res'):
+            peak, duration, vertices, volume, voxels = measure_surface(implementation, shape, new_size)
+            volumes[implementation] = volume
+            if voxels is not None:
+                volumes['voxels'] = voxels
+            print("%-7s %s -> %s: peak %6.0f MB %.2fs, %d vertices, volume %.0f" % (implementation, "x".join([str(s) for s in shape[2:]]),
+                  "x".join([str(s) for s in new_size[2:]]), peak / 1024**2, duration, vertices, volume))
+        difference = abs(volumes['low_res'] - volumes['voxels']) / volumes['voxels']
+        ok = difference <= MAX_VOLUME_DIFFERENCE  # also fails for inwards oriented faces (negative volume)
+        failed |= not ok
+        print("  enclosed volume differs by %.2f%% from the mask (%d voxels) %s" % (100 * difference, volumes['voxels'], "ok" if ok else "FAILED"))
+    sys.exit(1 if failed else 0)
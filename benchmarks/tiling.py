@@ -0,0 +1,75 @@
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import torch
+
+# internal imports
+from modules.Instrumentation import RSSSampler, current_rss
+from modules.Predictor import SegmentationPredictor
+from benchmarks.inference import random_weights
+
+# compares RUNet.forward_tiled with the untiled forward pass (output difference, peak memory, time):
+# python -m benchmarks.tiling [size] [tile_size...]  (exit code 1 if outputs differ by more than MAX_DIFFERENCE)
+
+MAX_DIFFERENCE = 1e-3  # float32 rounding of slab-wise convolutions and in-place GroupNorm, amplified by deeper GroupNorms
+
+
+def forward(weights_file, size, tile_size, output_path, queue):
+    # runs in a fresh process -> peak RSS only covers this forward pass
+    predictor = SegmentationPredictor()
+    predictor.device = 'cpu'
+    predictor.weights_file = weights_file
+    model = predictor.load_model()
+    torch.manual_seed(0)
+    input_tc = torch.rand((1, 1, size, size, size))
+    sampler = RSSSampler(0.002)
+    sampler.start()
+    baseline = current_rss()
+    start = time.perf_counter()
+    with torch.set_grad_enabled(False):
+        output_tc = model(input_tc) if tile_size is None else model.forward_tiled(input_tc, tile_size)
+    duration = time.perf_counter() - start
+    sampler.stop()
+    torch.save(output_tc, output_path)
+    queue.put((sampler.peak() - baseline, duration))
+
+
+def measure(weights_file, size, tile_size, output_path):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=forward, args=(weights_file, size, tile_size, output_path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 192
+    tile_sizes = [int(t) for t in sys.argv[2:]] if len(sys.argv) > 2 else [16, 32]
+    work_dir = tempfile.mkdtemp()
+    weights_file = SegmentationPredictor().weights_file
+    if not os.path.exists(weights_file):
+        weights_file = os.path.join(work_dir, "random_weights")
+        random_weights(weights_file, SegmentationPredictor())
+        print("No trained weights found, using random weights")
+
+    reference_path = os.path.join(work_dir, "untiled.pt")
+    peak, duration = measure(weights_file, size, None, reference_path)
+    print("untiled      %d^3: peak %6.0f MB (%3.0f B/voxel) %.1fs" % (size, peak / 1024**2, peak / size**3, duration))
+    reference = torch.load(reference_path)
+    failed = False
+    for tile_size in tile_sizes:
+        path = os.path.join(work_dir, "tiled_%d.pt" % tile_size)
+        tiled_peak, tiled_duration = measure(weights_file, size, tile_size, path)
+        output = torch.load(path)
+        difference = (output - reference).abs().max().item()
+        changed = ((output > 0.5) != (reference > 0.5)).sum().item()
+        ok = difference <= MAX_DIFFERENCE and tiled_peak < peak
+        failed |= not ok
+        print("tile %3d     %d^3: peak %6.0f MB (%3.0f B/voxel) %.1fs, max difference %.1e, %d voxels changed at 0.5 %s"
+              % (tile_size, size, tiled_peak / 1024**2, tiled_peak / size**3, tiled_duration, difference, changed, "ok" if ok else "FAILED"))
+    sys.exit(1 if failed else 0)
@@ -24,6 +24,24 @@ SYM_NO = "\u2716"
 # global execution flags
 #EXPAND_PATIENTS = True
 SHOW_MODEL_MISMATCH_WARNING = False
+CNN_WARMUP = True # load CNN weights in the background after startup
+PREDICTION_CACHE = True # reuse CNN predictions of unchanged volumes and settings
+CNN_SURFACE_PREVIEW = False # show the lumen surface of the model resolution CNN output, the label map is computed when editing starts or on save
 
 # global parameter constants
 MIN_CLUSTER_SIZE = 2000 # minimal cluster size (voxels) computed by automatic segmentation
+CNN_BYTES_PER_VOXEL = 150 # approximate peak memory (bytes) of a RUNet forward pass per input voxel (float32, CPU)
+CNN_TILED_BYTES_PER_VOXEL = 80 # same for tiled execution of the full resolution stages (SegmentationPredictor.tile_size)
+CNN_MAX_BATCH_MEMORY = 8*1024**3 # bytes of estimated forward pass memory per batch of queued cases (run_queue); one 400^3 input needs ~9.6 GB, so 'whole' cases run one by one unless raised to ~20 GB (2 cases)
+PREDICTION_CACHE_DIR = "~/.aortaanalyzer/prediction_cache" # shared by all patients
+PREDICTION_CACHE_SIZE = 2*1024**3 # maximal size (bytes) of cached predictions, least recently used are deleted first
+THREAD_CONFIG_FILE = "~/.aortaanalyzer/thread_config.json" # CNN thread configurations per host, written by modules/ThreadTuner.py
+CNN_GRID_SPACING = None # mm per CNN input voxel, e.g. 1.0: input size from the physical extent of the scan (SegmentationPredictor.input_size), None: fixed output_size
+CNN_BACKEND = 'torch' # 'torch': float RUNet, 'int8': quantized convolutions (python -m modules.Quantization), 'onnx': ONNX Runtime (python -m modules.OnnxBackend), both CPU only
+CNN_ONNX_INTRA_OP_THREADS = 0 # ONNX Runtime threads per operator (0: all physical cores)
+CNN_ONNX_INTER_OP_THREADS = 0 # ONNX Runtime threads for parallel operators (0: sequential execution)
+CNN_ONNX_OPTIMIZATION_LEVEL = 'all' # ONNX Runtime graph optimization: 'disable', 'basic', 'extended' or 'all'
+CNN_THREAD_CONFIG = None # manual override of the tuned configuration, e.g. {'num_threads': 8, 'num_interop_threads': 1, 'cpu_affinity': [1, 2, 3, 4, 5, 6, 7, 8]}
+INSTRUMENTATION_LOG = None # JSON lines file receiving timing/memory records of every CNN prediction (e.g. "~/.aortaanalyzer/predictions.jsonl")
+INFERENCE_SERVER = "~/.aortaanalyzer/inference.sock" # socket (or "localhost:<port>") of the local inference server (python -m modules.InferenceServer), used if it is running; None: always predict in-process
+INFERENCE_SERVER_KEY = "~/.aortaanalyzer/inference.key" # authentication key of the inference server, created on its first start (readable by the owner only)
@@ -0,0 +1,285 @@
+import collections
+import os
+import socket
+import threading
+import types
+import uuid
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+# internal imports
+from modules.ParallelInference import SharedArray
+from defaults import *
+
+# local inference daemon: one warm model serves the predictions of all GUI instances on this machine (SegmentationPredictor
+# with inference_server set uses it while it is running). Volumes and masks are passed through shared memory, only settings and
+# progress go over the socket. Requests of different clients are served round robin:
+# python -m modules.InferenceServer [--address localhost:6011]
+
+# predictor attributes sent with each request (the server predicts like the client would)
+CASE_SETTINGS = ['output_size', 'grid_spacing', 'grid_min_size', 'grid_max_size', 'grid_multiple', 'grid_max_voxels', 'windowing', 'inference_mode', 'coarse_size', 'roi_margin', 'body_crop', 'body_threshold', 'body_margin',
+                 'patch_size', 'patch_overlap', 'patch_batch_size', 'postprocess', 'tile_size', 'use_compiled_model']
+
+
+def server_address(address=None):
+    # "host:port" -> TCP address, otherwise path of a Unix socket
+    address = INFERENCE_SERVER if address is None else address
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return (host, int(port))
+    return os.path.expanduser(address)
+
+
+def auth_key(create=False):
+    # key shared by server and clients (file readable by the owner only), None if there is none
+    path = os.path.expanduser(INFERENCE_SERVER_KEY)
+    if create and not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+            f.write(os.urandom(32))
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def model_settings(predictor):
+    # a client only uses a server that predicts with the same model
+    settings = {'weights': predictor.weights_file_hash(), 'backend': predictor.backend, 'precision': predictor.precision,
+                'fuse_norm_activation': predictor.fuse_norm_activation}
+    if predictor.backend == 'int8':
+        stat = os.stat(predictor.quantized_weights_file)
+        settings['quantized_weights'] = [stat.st_size, stat.st_mtime_ns]
+    return settings
+
+
+class FairQueue():
+    """
+    Pending requests of several clients. Clients take turns (round robin), the requests of one client are served in order,
+    so a client submitting many cases does not delay the others by more than one case each.
+    """
+    def __init__(self):
+        self.pending = collections.OrderedDict()  # client -> deque of requests, in serving order
+        self.condition = threading.Condition()
+
+    def put(self, client, request):
+        with self.condition:
+            self.pending.setdefault(client, collections.deque()).append(request)
+            self.condition.notify()
+
+    def get(self):
+        # next request, blocks while the queue is empty
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            client, requests = next(iter(self.pending.items()))
+            request = requests.popleft()
+            if requests:
+                self.pending.move_to_end(client)
+            else:
+                del self.pending[client]
+            return request
+
+    def ahead(self, client):
+        # requests served before a new request of client
+        with self.condition:
+            own = len(self.pending.get(client, ()))
+            count, before = own, True  # clients before client in the rotation take one turn more
+            for other, requests in self.pending.items():
+                if other == client:
+                    before = False
+                else:
+                    count += min(len(requests), own + 1 if before else own)
+            return count
+
+
+class InferenceServer():
+    """
+    Daemon serving the predictions of InferenceClients with one warm SegmentationPredictor.
+    Each connection carries one request and is handled by its own thread, the predictions run one after the other.
+    """
+    def __init__(self, predictor, address=None):
+        self.predictor = predictor
+        self.predictor.inference_server = None  # predicts in-process
+        self.predictor.cache = None             # clients look up and store their predictions
+        self.address = server_address(address)
+        self.queue = FairQueue()
+        self.active = None  # request being predicted
+
+    def serve_forever(self):
+        self.predictor.warm_up()
+        self.settings = model_settings(self.predictor)
+        if isinstance(self.address, str):
+            self.__removeStaleSocket()
+        listener = Listener(self.address, authkey=auth_key(create=True))
+        if isinstance(self.address, str):
+            os.chmod(self.address, 0o600)
+        threading.Thread(target=self.__predictLoop, daemon=True).start()
+        print("Inference server listening on", self.address)
+        try:
+            while True:
+                try:
+                    connection = listener.accept()
+                except (OSError, EOFError, AuthenticationError):
+                    continue  # failed handshake of a client
+                threading.Thread(target=self.__handle, args=(connection,), daemon=True).start()
+        finally:
+            listener.close()
+
+    def __removeStaleSocket(self):
+        # socket file of a server that did not shut down cleanly
+        if not os.path.exists(self.address):
+            return
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(self.address)
+        except OSError:
+            os.remove(self.address)
+            return
+        finally:
+            probe.close()
+        raise RuntimeError("Inference server already running on " + self.address)
+
+    def __handle(self, connection):
+        try:
+            request = connection.recv()
+            if request['model'] != self.settings:
+                connection.send(('rejected', "server predicts with a different model"))
+            elif request['kind'] == 'status':
+                connection.send(('status', self.queue.ahead(request['client']) + (self.active is not None)))
+            else:
+                # the prediction thread answers from here on
+                connection.send(('queued', self.queue.ahead(request['client']) + (self.active is not None)))
+                request['connection'], request['done'] = connection, threading.Event()
+                self.queue.put(request['client'], request)
+                request['done'].wait()
+        except (OSError, EOFError):
+            pass  # client gone
+        finally:
+            connection.close()
+
+    def __predictLoop(self):
+        while True:
+            request = self.queue.get()
+            self.active = request
+            try:
+                self.__predict(request)
+            except Exception as e:
+                self.__send(request, 'error', repr(e))
+            finally:
+                self.active = None
+                request['done'].set()
+
+    def __predict(self, request):
+        for name, value in request['settings'].items():
+            setattr(self.predictor, name, value)
+        volume = SharedArray(request['shape'], request['dtype'], request['volume'], track=False)
+        output = SharedArray(request['shape'][::-1] if request['transposed'] else request['shape'], np.uint8, request['output'], track=False)
+        prediction, error = None, None
+        self.predictor.progress = types.SimpleNamespace(emit=lambda value, message: self.__send(request, 'progress', value, message))
+        array = volume.array.T if request['transposed'] else volume.array
+        array.flags.writeable = False
+        try:
+            prediction = self.predictor.predict(array, request['spacing'])
+            np.copyto(output.array, prediction, casting='unsafe')
+        except Exception as e:
+            error = repr(e)  # the traceback (views of the shared memory) is released with e
+        dtype = str(prediction.dtype) if prediction is not None else None
+        del array, prediction
+        volume.close()
+        output.close()
+        if error is None:
+            self.__send(request, 'done', dtype)
+        else:
+            self.__send(request, 'error', error)
+
+    def __send(self, request, *message):
+        try:
+            request['connection'].send(message)
+        except (OSError, EOFError):
+            pass
+
+
+class InferenceClient():
+    """
+    Predictions of the local inference server. predict and status return None if no server is running or it predicts with
+    a different model (the caller predicts in-process then).
+    """
+    def __init__(self, address=None):
+        self.address = server_address(address)
+        self.client = "%s-%d-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])  # one GUI instance takes one turn
+
+    def status(self, predictor):
+        # number of requests the server would predict before a new one of this client
+        reply = self.__request({'kind': 'status'}, predictor)
+        return reply[1] if reply is not None and reply[0] == 'status' else None
+
+    def predict(self, volume, predictor, spacing=None):
+        # mask of volume (as predictor.predict(volume, spacing)), progress is reported through predictor.progress
+        if self.status(predictor) is None:  # no server with this model, nothing allocated or copied
+            return None
+        transposed = volume.flags.f_contiguous and not volume.flags.c_contiguous
+        source = volume.T if transposed else volume  # shared copy in the memory order of volume (VTK buffers are Fortran ordered)
+        shared_volume = SharedArray(source.shape, source.dtype)
+        output = SharedArray(volume.shape, np.uint8)
+        try:
+            np.copyto(shared_volume.array, source)
+            request = {'kind': 'predict', 'volume': shared_volume.name, 'output': output.name, 'shape': source.shape,
+                       'dtype': str(source.dtype), 'transposed': transposed, 'spacing': None if spacing is None else tuple(spacing)}
+            reply = self.__request(request, predictor, predictor.progress.emit)
+            if reply is None:
+                return None
+            if reply[0] != 'done':
+                print("Inference server:", reply[1])
+                return None
+            return np.array(output.array, dtype=reply[1])  # copy out of the shared memory
+        finally:
+            shared_volume.close()
+            output.close()
+
+    def __request(self, request, predictor, progress=None):
+        # send request, forward progress until the final reply; None if the server is not reachable
+        key = auth_key()
+        if key is None:
+            return None
+        try:
+            request.update({'client': self.client, 'model': model_settings(predictor),
+                            'settings': {name: getattr(predictor, name) for name in CASE_SETTINGS}})
+            connection = Client(self.address, authkey=key)
+        except (OSError, EOFError, AuthenticationError):
+            return None
+        try:
+            connection.send(request)
+            while True:
+                reply = connection.recv()
+                if reply[0] == 'queued':
+                    if reply[1] and progress is not None:
+                        progress(0, "Waiting for inference server (%d cases ahead) ..." % reply[1])
+                elif reply[0] == 'progress':
+                    if progress is not None:
+                        progress(reply[1], reply[2])
+                else:
+                    return reply
+        except (OSError, EOFError):
+            print("Inference server connection lost")
+            return None
+        finally:
+            connection.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    from modules.Predictor import SegmentationPredictor
+
+    parser = argparse.ArgumentParser(description="Serve CNN predictions of all AortaAnalyzer instances on this machine")
+    parser.add_argument("--address", default=None, help="Unix socket path or host:port (default: INFERENCE_SERVER)")
+    parser.add_argument("--weights", default=None, help="weights file (default: weights of the predictor)")
+    args = parser.parse_args()
+
+    predictor = SegmentationPredictor()
+    if args.weights:
+        predictor.weights_file = args.weights
+    InferenceServer(predictor, args.address).serve_forever()
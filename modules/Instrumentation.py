@@ -0,0 +1,199 @@
+import json
+import os
+import platform
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+# per-stage wall time, CPU time and peak memory of prediction runs, one JSON serializable record per run:
+# python -m modules.Instrumentation runs.jsonl  (aggregate logged records)
+
+
+def current_rss():
+    # resident set size (bytes) of this process, None if unknown
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class RSSSampler():
+    """
+    Background thread polling the resident set size, peak() returns the maximum since the last reset().
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.maximum = current_rss()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.maximum is None:
+            return  # no /proc, peak RSS is not recorded
+        self.thread = threading.Thread(target=self.__sample, daemon=True)
+        self.thread.start()
+
+    def __sample(self):
+        while not self.stop_event.wait(self.interval):
+            self.update()
+
+    def update(self):
+        rss = current_rss()
+        if rss is not None and (self.maximum is None or rss > self.maximum):
+            self.maximum = rss
+
+    def reset(self):
+        self.maximum = current_rss()
+
+    def peak(self):
+        self.update()
+        return self.maximum
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class Instrumentation():
+    """
+    Records stages of prediction runs: with instrumentation.run(...): with instrumentation.stage('forward'): ...
+    Finished runs are kept in records (last_record) and appended to log_file (JSON lines) if set.
+    """
+    def __init__(self, log_file=None, max_records=100):
+        self.log_file = log_file
+        self.max_records = max_records
+        self.records = []
+        self.last_record = None
+        self.record = None
+        self.sampler = None
+        self.depth = 0
+        self.device = 'cpu'
+
+    @contextmanager
+    def run(self, **info):
+        # nested runs (run_inferrence -> predict) are recorded as one
+        self.depth += 1
+        if self.depth > 1:
+            try:
+                yield self.record
+            finally:
+                self.depth -= 1
+            return
+        self.record = {'timestamp': time.time(), 'host': platform.node(), 'stages': []}
+        self.record.update(info)
+        self.sampler = RSSSampler()
+        self.sampler.start()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield self.record
+        finally:
+            self.depth -= 1
+            self.record['wall_time'] = time.perf_counter() - start_wall
+            self.record['cpu_time'] = time.process_time() - start_cpu
+            self.record['peak_rss'] = max([s['peak_rss'] for s in self.record['stages'] if s['peak_rss'] is not None], default=None)
+            if resource is not None:
+                self.record['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # process lifetime peak
+            self.sampler.stop()
+            self.__finish(self.record)
+            self.record = None
+
+    @contextmanager
+    def stage(self, name):
+        # no-op outside of a run
+        if self.record is None:
+            yield
+            return
+        torch = self.__cuda()
+        if torch is not None:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        self.sampler.reset()
+        rss_start = current_rss()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            if torch is not None:
+                torch.cuda.synchronize()
+            entry = {'name': name, 'wall_time': time.perf_counter() - start_wall, 'cpu_time': time.process_time() - start_cpu,
+                     'rss_start': rss_start, 'peak_rss': self.sampler.peak()}
+            if torch is not None:
+                entry['cuda_peak_allocated'] = torch.cuda.max_memory_allocated()
+                entry['cuda_peak_reserved'] = torch.cuda.max_memory_reserved()
+            self.record['stages'].append(entry)
+
+    def summary(self, record=None):
+        # one line for the status bar, last run by default
+        record = self.last_record if record is None else record
+        if record is None:
+            return ""
+        stages = ", ".join(["%s %.1fs" % (s['name'], s['wall_time']) for s in record['stages']])
+        text = "CNN segmentation %.1fs (%s)" % (record['wall_time'], stages)
+        if record.get('peak_rss') is not None:
+            text += ", peak memory %.1f GB" % (record['peak_rss'] / 1024**3)
+        if record.get('body_crop_ratio') is not None:
+            text += ", body crop %.0f%%" % (100 * record['body_crop_ratio'])
+        if record.get('grid_spacing') is not None and record.get('input_size') is not None:
+            text += ", input grid " + "x".join([str(s) for s in record['input_size']])
+        return text
+
+    def __cuda(self):
+        # torch allocator statistics are only available for CUDA devices
+        if not str(self.device).startswith('cuda'):
+            return None
+        import torch
+        return torch if torch.cuda.is_available() else None
+
+    def __finish(self, record):
+        self.last_record = record
+        self.records.append(record)
+        del self.records[:-self.max_records]
+        if self.log_file is not None:
+            path = os.path.expanduser(self.log_file)
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+
+
+def aggregate(records):
+    # statistics per stage over runs: {stage: {'runs', 'wall_mean', 'wall_median', 'wall_max', 'cpu_mean', 'peak_rss_max'}}
+    stages = {}
+    for record in records:
+        for entry in record['stages']:
+            stages.setdefault(entry['name'], []).append(entry)
+    stages['total'] = [{'wall_time': r['wall_time'], 'cpu_time': r['cpu_time'], 'peak_rss': r.get('peak_rss')} for r in records]
+    result = {}
+    for name, entries in stages.items():
+        wall = [e['wall_time'] for e in entries]
+        peaks = [e['peak_rss'] for e in entries if e.get('peak_rss') is not None]
+        result[name] = {'runs': len(entries), 'wall_mean': float(np.mean(wall)), 'wall_median': float(np.median(wall)), 'wall_max': float(np.max(wall)),
+                        'cpu_mean': float(np.mean([e['cpu_time'] for e in entries])), 'peak_rss_max': max(peaks) if peaks else None}
+    return result
+
+
+def load_records(path):
+    with open(os.path.expanduser(path)) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Aggregate logged prediction records per stage")
+    parser.add_argument("log_files", nargs="+", help="JSON lines files written by Instrumentation (INSTRUMENTATION_LOG)")
+    args = parser.parse_args()
+
+    records = [record for path in args.log_files for record in load_records(path)]
+    print(len(records), "runs")
+    print("%-20s %5s %9s %9s %9s %9s %10s" % ("stage", "runs", "wall", "median", "max", "cpu", "peak RSS"))
+    for name, stats in aggregate(records).items():
+        peak = "%8.2fGB" % (stats['peak_rss_max'] / 1024**3) if stats['peak_rss_max'] is not None else "-"
+        print("%-20s %5d %8.2fs %8.2fs %8.2fs %8.2fs %10s" % (name, stats['runs'], stats['wall_mean'], stats['wall_median'], stats['wall_max'], stats['cpu_mean'], peak))
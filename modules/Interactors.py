@@ -3,7 +3,7 @@ import os
 import numpy as np 
 import nrrd 
 import vtk 
-from vtk.util.numpy_support import numpy_to_vtk
+from vtk.util.numpy_support import numpy_to_vtk, numpy_to_vtkIdTypeArray
 from PyQt6.QtCore import pyqtSignal
 from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 
@@ -146,8 +146,10 @@ class IsosurfaceInteractor(QVTKRenderWindowInteractor):
         self.smoother_lumen.SetInputConnection(self.clean_lumen.GetOutputPort())
         self.smoother_lumen.SetNumberOfIterations(20)
         self.smoother_lumen.SetPassBand(0.005)
+        self.surface_lumen = vtk.vtkPassThrough()  # displayed surface: smoothed isosurface or a precomputed mesh (showSurface)
+        self.surface_lumen.SetInputConnection(self.smoother_lumen.GetOutputPort())
         self.mapper_lumen = vtk.vtkPolyDataMapper()
-        self.mapper_lumen.SetInputConnection(self.smoother_lumen.GetOutputPort())
+        self.mapper_lumen.SetInputConnection(self.surface_lumen.GetOutputPort())
         self.mapper_lumen.ScalarVisibilityOff()
         self.actor_lumen = vtk.vtkActor()
         self.actor_lumen.GetProperty().SetColor(COLOR_LUMEN)
@@ -218,13 +220,17 @@ class IsosurfaceInteractor(QVTKRenderWindowInteractor):
         return label_map, lumen_pending
 
 
-    def updateScene(self, label_map_data, label_map_vtk):
+    def updateScene(self, label_map_data, label_map_vtk, has_lumen=None):
+        # has_lumen: known by the caller (e.g. CNN prediction) -> no scan of the label map
         extent = np.array(label_map_vtk.GetExtent())
         extent += np.array([-1, 1, -1, 1, -1, 1])
         self.padding.SetInputData(label_map_vtk)
         self.padding.SetOutputWholeExtent(extent)
+        self.surface_lumen.SetInputConnection(self.smoother_lumen.GetOutputPort())
 
-        if 1.0 in label_map_data:
+        if has_lumen is None:
+            has_lumen = 1.0 in label_map_data
+        if has_lumen:
             self.renderer.AddActor(self.actor_lumen)
             lumen_pending = False
         else:
@@ -236,8 +242,31 @@ class IsosurfaceInteractor(QVTKRenderWindowInteractor):
         return lumen_pending
 
 
+    def showSurface(self, vertices, faces):
+        # display a precomputed triangle mesh (world coordinates) instead of the isosurface of the label map
+        points = vtk.vtkPoints()
+        points.SetData(numpy_to_vtk(vertices, deep=True))
+        polys = vtk.vtkCellArray()
+        polys.SetData(3, numpy_to_vtkIdTypeArray(faces.astype(np.int64).ravel(), deep=True))
+        surface = vtk.vtkPolyData()
+        surface.SetPoints(points)
+        surface.SetPolys(polys)
+        self.surface_lumen.SetInputData(surface)
+
+        if len(faces) > 0:
+            self.renderer.AddActor(self.actor_lumen)
+            lumen_pending = False
+        else:
+            self.renderer.RemoveActor(self.actor_lumen)
+            lumen_pending = True
+        self.renderer.ResetCamera()
+
+        return lumen_pending
+
+
     def reset(self):
         # remove actors from window
+        self.surface_lumen.SetInputConnection(self.smoother_lumen.GetOutputPort())
         self.renderer.RemoveActor(self.actor_lumen)
         self.GetRenderWindow().Render()
 
@@ -0,0 +1,87 @@
+import os
+
+import numpy as np
+import onnxruntime
+
+# only numpy and onnxruntime are needed to run exported models, torch is imported by the exporter
+
+OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+def onnx_model_path(weights_file, input_shape):
+    # spatial shape of the network input is fixed at export (decoder padding), batch size is dynamic
+    return weights_file + "." + "x".join([str(s) for s in input_shape]) + ".onnx"
+
+
+def export_onnx(model, path, input_shape, opset_version=18):
+    # write RUNet to ONNX for inputs of shape (batch, 1, *input_shape)
+    import torch
+    dummy_input = torch.zeros((1, 1, *input_shape))
+    with torch.set_grad_enabled(False):
+        torch.onnx.export(model.cpu().eval(), (dummy_input,), path,
+                          input_names=['input'], output_names=['output'],
+                          dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+                          opset_version=opset_version)
+
+
+class OnnxModel():
+    """
+    RUNet executed with ONNX Runtime's CPU execution provider (numpy in, numpy out).
+    One inference session per exported input shape, sessions are created on first use.
+    """
+    def __init__(self, weights_file, intra_op_threads=0, inter_op_threads=0, optimization_level='all'):
+        self.weights_file = weights_file
+        self.session_options = onnxruntime.SessionOptions()
+        self.session_options.intra_op_num_threads = intra_op_threads  # 0: onnxruntime default (all physical cores)
+        self.session_options.inter_op_num_threads = inter_op_threads
+        self.session_options.graph_optimization_level = OPTIMIZATION_LEVELS[optimization_level]
+        if inter_op_threads > 1:
+            self.session_options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        self.sessions = {}
+        self.missing = set()  # input shapes without export, reported once
+
+    def available(self, input_shape):
+        # exported model for input_shape exists, otherwise the predictor runs the shape with torch
+        if input_shape in self.sessions or os.path.exists(onnx_model_path(self.weights_file, input_shape)):
+            return True
+        if input_shape not in self.missing:
+            self.missing.add(input_shape)
+            print("No ONNX model for input shape", list(input_shape), "- running it with torch (export: python -m modules.OnnxBackend --shape " + " ".join([str(s) for s in input_shape]) + ")")
+        return False
+
+    def session(self, input_shape):
+        if input_shape not in self.sessions:
+            path = onnx_model_path(self.weights_file, input_shape)
+            if not os.path.exists(path):
+                raise FileNotFoundError("No ONNX model for input shape " + str(list(input_shape)) + ", export it with: python -m modules.OnnxBackend --shape " + " ".join([str(s) for s in input_shape]))
+            self.sessions[input_shape] = onnxruntime.InferenceSession(path, self.session_options, providers=['CPUExecutionProvider'])
+        return self.sessions[input_shape]
+
+    def __call__(self, input_array):
+        input_array = np.ascontiguousarray(input_array, dtype=np.float32)
+        return self.session(tuple(input_array.shape[2:])).run(['output'], {'input': input_array})[0]
+
+
+if __name__ == "__main__":
+    # export the network for the input shapes used by the predictor:
+    # python -m modules.OnnxBackend [--shape 400 400 400] [--shape 192 192 192]
+    import argparse
+    from modules.Predictor import SegmentationPredictor
+
+    parser = argparse.ArgumentParser(description="Export RUNet with trained weights to ONNX")
+    parser.add_argument("--shape", nargs=3, type=int, action="append", help="spatial input shape (default: output_size and patch_size of the predictor)")
+    parser.add_argument("--opset", type=int, default=18)
+    args = parser.parse_args()
+
+    predictor = SegmentationPredictor()
+    predictor.device = 'cpu'
+    shapes = args.shape if args.shape else [predictor.output_size, predictor.patch_size]
+    for shape in shapes:
+        path = onnx_model_path(predictor.weights_file, shape)
+        export_onnx(predictor.load_model(), path, shape, args.opset)
+        print("Exported", path)
@@ -0,0 +1,195 @@
+import multiprocessing
+import os
+import queue
+import types
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import torch
+
+# internal imports
+from modules.ThreadTuner import available_cpus, set_thread_counts
+
+# data parallel sliding window inference of one case: overlapping windows of the normalized volume are predicted by a pool
+# of worker processes (few threads, own model replica each, weights shared via memory mapping, see modules/SharedWeights.py).
+# Input volume and blending accumulators live in shared memory, only window positions are sent to the workers.
+
+# predictor attributes copied into the worker replicas
+WORKER_SETTINGS = ['weights_file', 'quantized_weights_file', 'backend', 'precision', 'mmap_weights', 'fuse_norm_activation', 'tile_size',
+                   'use_compiled_model', 'onnx_optimization_level']
+
+
+class SharedArray():
+    """
+    Numpy array in (named) shared memory, attached by other processes with SharedArray(name=..., shape=...).
+    New shared memory is zero filled. track=False: attached by a process that is not started by the owner (its resource
+    tracker would unlink the memory when the process exits).
+    """
+    def __init__(self, shape, dtype=np.float32, name=None, track=True):
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        if not self.owner and not track:
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def close(self):
+        self.array = None
+        if self.owner:
+            self.memory.unlink()  # freed as soon as the last mapping is closed
+        try:
+            self.memory.close()
+        except BufferError:
+            pass  # views are still referenced (e.g. by the traceback of a failed prediction), unmapped when they are deleted
+
+
+def worker(settings, threads, cpus, tasks, results, lock):
+    # worker process: own model replica, predicts windows of the shared input into the shared accumulators
+    set_thread_counts({'num_threads': threads, 'num_interop_threads': 1})  # before torch starts its thread pools
+    from modules.Predictor import SegmentationPredictor
+    predictor = SegmentationPredictor()
+    predictor.device = 'cpu'
+    predictor.cache = None
+    predictor.progress = types.SimpleNamespace(emit=lambda value, msg: None)  # the class signal is unbound outside the GUI
+    for name, value in settings.items():
+        setattr(predictor, name, value)
+    predictor.onnx_intra_op_threads = threads
+    predictor.configure_threads({'num_threads': threads, 'num_interop_threads': 1, 'cpu_affinity': cpus})
+    predictor.pin_thread()
+    predictor.load_model()
+    results.put(('ready', None, os.getpid()))
+
+    job, weight_map = None, None
+    with torch.set_grad_enabled(False):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            # the shared arrays are attached per window: an idle worker maps no volume (the memory is freed as soon as the
+            # parent unlinks it), attaching costs far less than the forward pass of a window
+            arrays, window_tc, output_tc = {}, None, None
+            try:
+                if task['job'] != job:
+                    job = task['job']
+                    weight_map = predictor.gaussian_weight_map(task['patch'])
+                arrays = {key: SharedArray(task['shape'], name=name) for key, name in task['arrays'].items()}
+                s = tuple(slice(start, stop) for start, stop in task['window'])
+                window_tc = torch.from_numpy(arrays['input'].array[s]).unsqueeze(0).unsqueeze(0)
+                output_tc = predictor.forward(window_tc)[0, 0] * weight_map
+                with lock:  # windows of other workers overlap
+                    arrays['sum'].array[s] += output_tc.numpy()
+                    arrays['weights'].array[s] += weight_map.numpy()
+                results.put(('done', job, task['index']))
+            except Exception as e:
+                results.put(('error', task['job'], repr(e)))
+            finally:
+                window_tc = output_tc = None  # views of the shared input
+                for array in arrays.values():
+                    array.close()
+
+
+class ParallelInference():
+    """
+    Pool of worker processes predicting the windows of one case in parallel (inference_mode 'parallel').
+    workers: number of processes (None: all available cpus divided by threads), threads: torch threads per worker.
+    Workers are started on first use and kept until close().
+    """
+    def __init__(self, predictor, workers=None, threads=4):
+        self.predictor = predictor
+        self.threads = threads
+        cpus = available_cpus()
+        self.workers = max(1, len(cpus) // threads) if workers is None else workers
+        self.processes = []
+        self.settings = None
+        self.job = 0
+        self.input = None
+        self.context = multiprocessing.get_context('spawn')
+
+    def start(self):
+        # (re)start the pool if it is not running or the model settings changed
+        settings = {name: getattr(self.predictor, name) for name in WORKER_SETTINGS}
+        if self.processes and settings == self.settings and all(p.is_alive() for p in self.processes):
+            return
+        self.__stop()
+        self.settings = settings
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        self.lock = self.context.Lock()
+        cpus = available_cpus()
+        for i in range(self.workers):
+            # consecutive cpus per worker if there are enough, otherwise the scheduler places the workers
+            worker_cpus = cpus[i*self.threads:(i+1)*self.threads] if len(cpus) >= self.workers * self.threads else None
+            process = self.context.Process(target=worker, args=(settings, self.threads, worker_cpus, self.tasks, self.results, self.lock), daemon=True)
+            process.start()
+            self.processes.append(process)
+        for _ in self.processes:
+            self.__result(None)  # 'ready' after the model replica is loaded
+
+    def input_array(self, shape):
+        # float32 array in shared memory for the normalized volume of the next predict call
+        self.release()
+        self.input = SharedArray(shape)
+        return self.input.array
+
+    def release(self):
+        # free the input volume, remaining references to input_array keep its mapping (not its name) until they are deleted
+        if self.input is not None:
+            self.input.close()
+            self.input = None
+
+    def predict(self, patch, slices, progress=None):
+        # blend the predictions of all windows (slices into the volume of input_array) -> binary mask
+        self.start()
+        shape = self.input.shape
+        accumulators = {'sum': SharedArray(shape), 'weights': SharedArray(shape)}
+        self.job += 1
+        try:
+            arrays = {'input': self.input.name, 'sum': accumulators['sum'].name, 'weights': accumulators['weights'].name}
+            for i, s in enumerate(slices):
+                self.tasks.put({'job': self.job, 'index': i, 'arrays': arrays, 'shape': shape, 'patch': tuple(patch),
+                                'window': [(w.start, w.stop) for w in s]})
+            for finished in range(1, len(slices) + 1):
+                self.__result(self.job)
+                if progress is not None:
+                    progress(finished, len(slices))
+            weights = accumulators['weights'].array
+            weights *= 0.5
+            return np.greater(accumulators['sum'].array, weights)
+        finally:
+            for array in accumulators.values():
+                array.close()
+
+    def __result(self, job):
+        # next message of the workers about job, fails if a worker died or reported an error
+        # (messages of earlier, failed jobs are skipped)
+        while True:
+            try:
+                message = self.results.get(timeout=1)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self.processes):
+                    self.__stop()
+                    raise RuntimeError("Parallel inference worker terminated")
+                continue
+            if message[1] != job:
+                continue
+            if message[0] == 'error':
+                raise RuntimeError("Parallel inference worker failed: " + message[2])
+            return message
+
+    def close(self):
+        self.release()
+        self.__stop()
+
+    def __stop(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
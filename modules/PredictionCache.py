@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+class PredictionCache():
+    """
+    On-disk cache of CNN predictions, content-addressed by volume, weights and predictor settings.
+    Masks are bit-packed and compressed, least recently used entries are evicted above max_size bytes.
+    """
+    def __init__(self, cache_dir, max_size=2*1024**3):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = max_size
+
+    def key(self, volume, predictor, spacing=None):
+        # blake2b over the volume array and everything the prediction depends on
+        h = hashlib.blake2b(digest_size=20)
+        settings = {
+            'shape': list(volume.shape),
+            'dtype': str(volume.dtype),
+            'weights': predictor.weights_file_hash(),
+            'backend': predictor.backend,
+            'precision': predictor.precision,
+            'output_size': list(predictor.output_size),
+            'input_size': list(predictor.input_size(volume.shape, spacing)),  # adaptive grid depends on the spacing
+            'windowing': predictor.windowing,
+            'postprocess': predictor.postprocess,
+            'inference_mode': predictor.inference_mode,
+            'patch_size': list(predictor.patch_size),
+            'patch_overlap': predictor.patch_overlap,
+            'coarse_size': list(predictor.coarse_size),
+            'roi_margin': predictor.roi_margin,
+            'body_crop': [predictor.body_crop, predictor.body_threshold, predictor.body_margin],
+            'tile_size': predictor.tile_size,
+            'fuse_norm_activation': predictor.fuse_norm_activation,
+        }
+        if predictor.backend == 'int8':
+            # recalibrated INT8 weights replace the file in place
+            stat = os.stat(predictor.quantized_weights_file)
+            settings['quantized_weights'] = [stat.st_size, stat.st_mtime_ns]
+        # hash the buffer in memory order, Fortran ordered volumes (VTK) are not copied
+        if volume.flags.f_contiguous and not volume.flags.c_contiguous:
+            settings['order'] = 'F'
+            volume = volume.T
+        h.update(json.dumps(settings, sort_keys=True).encode())
+        volume = np.ascontiguousarray(volume)
+        h.update(volume.reshape(-1).view(np.uint8))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, key):
+        # cached prediction or None
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                shape = tuple(entry['shape'])
+                mask = np.unpackbits(entry['bits'], count=int(np.prod(shape))).reshape(shape)
+                prediction = mask.astype(str(entry['dtype']))
+        except (OSError, KeyError, ValueError) as e:
+            if os.path.exists(path):
+                print("Removing unreadable cache entry", path, e)
+                os.remove(path)
+            return None
+        os.utime(path)  # mark as recently used
+        return prediction
+
+    def put(self, key, prediction):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        tmp_path = path + ".tmp.npz"
+        bits = np.packbits(prediction.astype(np.bool_), axis=None)
+        np.savez_compressed(tmp_path, bits=bits, shape=np.array(prediction.shape), dtype=np.array(str(prediction.dtype)))
+        os.replace(tmp_path, path)  # no partially written entries on concurrent reads
+        self.evict()
+
+    def evict(self):
+        # delete least recently used entries until the cache fits into max_size
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz") and not name.endswith(".tmp.npz"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
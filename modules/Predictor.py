@@ -1,16 +1,24 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import warnings
+
 import numpy as np 
 
 import torch 
-import torch.nn.functional as F
 import skimage.measure as measure
 from skimage import morphology
 from PyQt6.QtCore import pyqtSignal
 #from torch.utils.tensorboard import SummaryWriter
 # internal imports 
-from modules.Runet import RUNet
+from modules.Instrumentation import Instrumentation
+from modules.PredictionCache import PredictionCache
+from modules.Runet import RUNet, fuse_for_inference
 from defaults import *
 
-# TODO: change interpolation/resampling method 
 class SegmentationPredictor():
     """
     Wrapper object to call segmentation predictions based on trained RUNet.
@@ -19,23 +27,146 @@ class SegmentationPredictor():
     progress = pyqtSignal(int,str)
     result = pyqtSignal(object)
     def __init__(self):
-        # set model 
+        # set model (built and loaded on first use, see load_model)
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        print("CNN with",self.device)
-        self.model = RUNet(**self.__network_config()).to(self.device)
-        #input_tensor = torch.randn(16, 1, 400, 400, 400)
-        #writer = SummaryWriter(log_dir="C:/Users/abeef/Desktop")
-        #writer.add_graph(self.model,input_tensor)
-        #writer.close()
-        self.trained = torch.load("best_model497", map_location=torch.device(self.device), weights_only=True)   # NG: best_model478_NG
-        self.model.load_state_dict(self.trained['model_state_dict'])
-        self.model = self.model.eval().to(self.device)
+        self.weights_file = "best_model497"   # NG: best_model478_NG
+        self.backend = CNN_BACKEND            # 'torch': float RUNet, 'int8': RUNet with quantized convolutions (CPU only), 'onnx': ONNX Runtime (CPU only)
+        self.quantized_weights_file = self.weights_file + "_int8"  # created by modules/Quantization.py
+        self.onnx_intra_op_threads = CNN_ONNX_INTRA_OP_THREADS  # ONNX Runtime threads per operator (0: all physical cores)
+        self.onnx_inter_op_threads = CNN_ONNX_INTER_OP_THREADS  # ONNX Runtime threads for parallel operators (0: sequential execution)
+        self.onnx_optimization_level = CNN_ONNX_OPTIMIZATION_LEVEL  # ONNX Runtime graph optimization: 'disable', 'basic', 'extended' or 'all'
+        self.mmap_weights = True              # map <weights_file>.mmap (python -m modules.SharedWeights) on CPU if present, processes share its pages
+        self.model = None
+        self.onnx_fallback = None             # torch model of backend 'onnx' for input shapes without export, see onnx_fallback_model
+        self.model_lock = threading.Lock()
         
         # set additional parameters for inference 
         self.postprocess = False
-        self.output_size = (400,400,400)     
+        self.output_size = (400,400,400)    # model input size of inference modes 'whole' and 'coarse_to_fine' (region density), without grid_spacing
+        self.grid_spacing = CNN_GRID_SPACING  # mm per model input voxel (number or per axis): input size from the physical extent of the volume instead of output_size
+        self.grid_min_size = 128            # bounds of the adaptive input size per axis
+        self.grid_max_size = 640
+        self.grid_multiple = 64             # input sizes are multiples of the total stride of RUNet (six stride 2 encoder stages)
+        self.grid_max_voxels = 400**3       # the grid is coarsened uniformly for larger inputs (runtime/memory bound of output_size)
         self.windowing = False
+        self.inference_mode = 'whole'       # 'whole': resample volume to output_size, 'sliding_window': overlapping windows at native resolution,
+                                            # 'coarse_to_fine': low resolution pass (coarse_size) locates the aorta, only the cropped region is predicted at the resolution of 'whole'
+                                            # 'parallel': windows as in 'sliding_window', predicted by a pool of worker processes (see modules/ParallelInference.py)
+        self.coarse_size = (128,128,128)    # model input size of the low resolution pass
+        self.roi_margin = 16                # voxels (original volume) added on each side of the aorta bounding box found by the low resolution pass
+        self.report = {}                    # crop ratio (body_crop) and stage timings (coarse_to_fine) of the last prediction
+        self.body_crop = False              # crop the volume to the bounding box of the patient body before inference
+        self.body_threshold = -500          # HU, voxels above belong to the body (or table)
+        self.body_margin = 8                # voxels added on each side of the body bounding box
+        self.tile_size = None               # run the full resolution stages of RUNet in slabs of tile_size slices (about half the peak memory, slower)
+        self.instrumentation = Instrumentation(INSTRUMENTATION_LOG)  # wall/CPU time and peak memory per stage of each run, see instrumentation.last_record
+        self.patch_size = (192,192,192)     # window size (voxels) for sliding window inference
+        self.patch_overlap = 0.5            # relative overlap of neighbouring windows
+        self.patch_batch_size = 1           # number of windows per forward pass
+        self.parallel_workers = None        # worker processes of inference_mode 'parallel' (None: available cpus / parallel_threads)
+        self.parallel_threads = 4           # torch threads per worker process
+        self.parallel_pool = None           # ParallelInference, started on first use
+        self.queue = []                     # pending cases (volume, callback) for batched inference with run_queue
+        self.max_batch_memory = CNN_MAX_BATCH_MEMORY  # upper bound (bytes) of estimated forward pass memory when batching queued cases
+        self.use_compiled_model = False     # run traced TorchScript artifacts (cached next to the weights) instead of the eager model
+        self.compiled_models = {}           # input shape -> loaded TorchScript module (None if compilation failed)
+        self.weights_hash = None            # sha256 of the weights file, computed on demand
+        self.precision = 'float32'          # 'float32' or 'bfloat16' (CPU autocast, falls back to float32 without native bfloat16 support)
+        self.mixed_precision_hooks = []     # hooks keeping GroupNorm and sigmoid in float32 under autocast
+        self.fuse_norm_activation = True    # eval model runs GroupNorm + LeakyReLU as one compiled kernel (see fuse_for_inference)
+        self.surface_preview = CNN_SURFACE_PREVIEW  # run_inferrence with spacing emits the 0.5 iso-surface of the model output (inference_mode 'whole', no postprocess), see predict_surface
+        self.deferred = None                # model output of the last predict_surface call, resampled to a mask by deferred_prediction
+        self.cache = PredictionCache(PREDICTION_CACHE_DIR, PREDICTION_CACHE_SIZE) if PREDICTION_CACHE else None  # on-disk predictions for run_inferrence
+        self.inference_server = INFERENCE_SERVER  # address of the local inference server (python -m modules.InferenceServer), predict uses it if it is running
+        self.server_client = None           # InferenceClient, created on first use
+        self.server_ready = False           # warm_up found a running inference server with the same model (no model loaded in-process)
+        self.thread_config = None           # torch thread counts and cpu affinity of predictions, see configure_threads
+        self.configure_threads()
         
+    def load_model(self):
+        # build RUNet and read weights once, safe to call from warm-up and prediction threads
+        with self.model_lock:
+            if self.model is None:
+                if self.backend == 'int8':
+                    from modules.Quantization import load_quantized_model
+                    self.device = 'cpu'
+                    print("CNN with",self.device,"(INT8)")
+                    self.model = load_quantized_model(self.build_network(), self.quantized_weights_file)
+                    return self.model
+                if self.backend == 'onnx':
+                    from modules.OnnxBackend import OnnxModel
+                    self.device = 'cpu'
+                    print("CNN with",self.device,"(ONNX Runtime)")
+                    self.model = OnnxModel(self.weights_file, self.onnx_intra_op_threads, self.onnx_inter_op_threads, self.onnx_optimization_level)
+                    return self.model
+                self.model = self.__loadFloatModel()
+        return self.model
+
+    def __loadFloatModel(self):
+        from modules.SharedWeights import load_mmap_weights, mmap_weights_path
+        mmap_file = mmap_weights_path(self.weights_file)
+        if self.mmap_weights and self.device == 'cpu' and os.path.exists(mmap_file):
+            state_dict = load_mmap_weights(mmap_file, self.weights_file_hash())
+            if state_dict is not None:
+                # parameters stay backed by the mapped file (no private copy)
+                print("CNN with",self.device,"(memory mapped weights)")
+                model = self.build_network()
+                model.load_state_dict(state_dict, assign=True)
+                return self.__eval(model)
+            print("Warning:", mmap_file, "was not converted from", self.weights_file, "- loading the checkpoint (convert again: python -m modules.SharedWeights " + self.weights_file + ")")
+        print("CNN with",self.device)
+        model = self.build_network().to(self.device)
+        #input_tensor = torch.randn(16, 1, 400, 400, 400)
+        #writer = SummaryWriter(log_dir="C:/Users/abeef/Desktop")
+        #writer.add_graph(self.model,input_tensor)
+        #writer.close()
+        trained = torch.load(self.weights_file, map_location=torch.device(self.device), weights_only=True)
+        model.load_state_dict(trained['model_state_dict'])
+        return self.__eval(model.to(self.device))
+
+    def onnx_fallback_model(self):
+        # float RUNet for input shapes without ONNX export (backend 'onnx': coarse_to_fine passes, adaptive grids, clipped windows)
+        with self.model_lock:
+            if self.onnx_fallback is None:
+                self.onnx_fallback = self.__loadFloatModel()
+        return self.onnx_fallback
+
+    def __eval(self, model):
+        # inference graph of the float model
+        model.eval()
+        return fuse_for_inference(model) if self.fuse_norm_activation else model
+    
+    def configure_threads(self, config=None):
+        # explicit config > CNN_THREAD_CONFIG (defaults.py) > tuned config of this host (python -m modules.ThreadTuner) > torch defaults
+        from modules.ThreadTuner import load_config, set_thread_counts
+        self.thread_config = config or CNN_THREAD_CONFIG or load_config()
+        if self.thread_config:
+            set_thread_counts(self.thread_config)
+
+    def pin_thread(self):
+        # keep the prediction thread (and its thread pools) on the configured cpus, e.g. away from the render thread
+        if self.thread_config:
+            from modules.ThreadTuner import pin_thread
+            pin_thread(self.thread_config.get('cpu_affinity'))
+
+    def warm_up(self):
+        # load weights and run a tiny dummy forward pass (initializes kernels/thread pools before the first prediction)
+        self.server_ready = self.inference_server is not None and self.serverClient().status(self) is not None
+        if self.server_ready:
+            return  # predictions run in the warm model of the inference server
+        self.pin_thread()
+        model = self.load_model()
+        if self.backend == 'onnx':
+            if model.available(tuple(self.output_size)):
+                model.session(tuple(self.output_size))  # create inference session of the whole volume input shape
+            return
+        with torch.set_grad_enabled(False):
+            model(torch.zeros((1, 1, 64, 64, 128), device=self.device))
+    
+    def build_network(self):
+        # untrained RUNet with the architecture of the trained weights
+        return RUNet(**self.__network_config())
+
     def __network_config(self):
        # define network parameters
         input_channels = [1, 6, 16, 64, 128, 256]
@@ -55,58 +186,815 @@ class SegmentationPredictor():
         return config 
     
     def resample(self, tensor, new_size, device, mode='bilinear'):
-        # from preprocessing volumetric
-        identity_transform = torch.eye(len(new_size)-1, device=device)[:-1, :].unsqueeze(0)
-        identity_transform = torch.repeat_interleave(identity_transform, new_size[0], dim=0)
-        sampling_grid = F.affine_grid(identity_transform, new_size, align_corners=False)
-        resampled_tensor = F.grid_sample(tensor, sampling_grid, mode=mode, padding_mode='zeros', align_corners=False)
+        # separable resampling with the geometry of grid_sample on an identity affine_grid (align_corners=False, zero padding),
+        # one spatial axis after the other without materializing a sampling grid; shrinking axes first keeps intermediates small
+        for dim in self.__resampleAxes(tensor, new_size):
+            tensor = self.__resampleAxis(tensor, dim, new_size[dim], device, mode)
+        return tensor
+
+    def resample_threshold(self, tensor, new_size, device, threshold=0.5, out=None, slab_size=16):
+        # resample a probability map (1,1,d,h,w) like resample and threshold it, slab by slab along the last axis into a
+        # boolean array (out or new): only the input tensor and one full resolution slab are kept in float precision.
+        # Every slab runs the same interpolation steps on the input slices it needs -> identical to resample + threshold
+        dim = tensor.dim() - 1
+        length, new_length = tensor.shape[dim], new_size[dim]
+        axes = self.__resampleAxes(tensor, new_size)
+        index0, _ = self.__samplePositions(length, new_length, device)
+        prediction = np.empty(tuple(new_size[2:]), dtype=np.bool_) if out is None else out
+        for start in range(0, new_length, slab_size):
+            stop = min(start + slab_size, new_length)
+            if length == new_length:
+                first, slab = start, tensor.narrow(dim, start, stop - start)
+            else:
+                first = int(index0[start:stop].min().clamp(0, length-1))
+                last = int((index0[start:stop].max() + 1).clamp(0, length-1))
+                slab = tensor.narrow(dim, first, last - first + 1)
+            for d in axes:
+                if d == dim:
+                    slab = self.__resampleAxis(slab, d, new_length, device, output_range=(start, stop), input_offset=first, input_length=length)
+                else:
+                    slab = self.__resampleAxis(slab, d, new_size[d], device)
+            prediction[..., start:stop] = (slab[0, 0] > threshold).cpu().numpy()
+            del slab
+        return prediction
+
+    def __resampleAxes(self, tensor, new_size):
+        axes = [dim for dim in range(2, tensor.dim()) if tensor.shape[dim] != new_size[dim]]
+        axes.sort(key=lambda dim: new_size[dim] / tensor.shape[dim])
+        return axes
+
+    def __samplePositions(self, length, new_length, device, mode='bilinear'):
+        # sample positions computed like affine_grid + grid_sample (float32) -> ties of nearest neighbour sampling match
+        position = torch.linspace(-1, 1, new_length, device=device) * (new_length - 1) / new_length
+        position = ((position + 1) * length - 1) / 2
+        if mode == 'nearest':
+            index0 = torch.round(position).long()
+        else:
+            index0 = torch.floor(position).long()
+        return index0, position - index0
+
+    def __resampleAxis(self, tensor, dim, new_length, device, mode='bilinear', slab_size=8, output_range=None, input_offset=0, input_length=None):
+        # 1D interpolation along dim into a preallocated output, a few output slices at a time (no full size temporaries)
+        # output_range: (start, stop) of the new_length output samples to compute, tensor then only holds the input slices
+        # from input_offset on of an input with input_length slices
+        length = tensor.shape[dim] if input_length is None else input_length
+        index0, weight1 = self.__samplePositions(length, new_length, device, mode)
+        weight1 = weight1.to(tensor.dtype)
+        if output_range is not None:
+            index0, weight1 = index0[output_range[0]:output_range[1]], weight1[output_range[0]:output_range[1]]
+        new_shape = list(tensor.shape)
+        new_shape[dim] = index0.shape[0]
+        resampled_tensor = tensor.new_empty(new_shape)
+        weight_shape = [1] * tensor.dim()
+        weight_shape[dim] = -1
+        for start in range(0, index0.shape[0], slab_size):
+            index = index0[start:start+slab_size]
+            slab = resampled_tensor.narrow(dim, start, index.shape[0])
+            slab.copy_(tensor.index_select(dim, index.clamp(0, length-1) - input_offset))
+            # samples outside of the tensor count as zero
+            slab.masked_fill_(((index < 0) | (index > length-1)).reshape(weight_shape), 0)
+            if mode != 'nearest':
+                upper = tensor.index_select(dim, (index+1).clamp(0, length-1) - input_offset)
+                upper.masked_fill_((index+1 > length-1).reshape(weight_shape), 0)
+                slab.lerp_(upper, weight1[start:start+slab_size].reshape(weight_shape))
         return resampled_tensor
         
     
-    def run_inferrence(self, volume): 
+    def bfloat16_available(self):
+        # native bfloat16 instructions (AVX512-BF16/AMX), without them autocast is emulated and slower than float32
+        if self.device != 'cpu':
+            return False
+        try:
+            with open("/proc/cpuinfo") as f:
+                cpu_flags = f.read().split()
+            return "avx512_bf16" in cpu_flags or "amx_bf16" in cpu_flags
+        except OSError:
+            pass
+        try:
+            return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+        except (AttributeError, RuntimeError):
+            return False
+    
+    def __forwardBfloat16(self, input_tc):
+        # convolutions in bfloat16, normalization statistics and sigmoid output stay in float32
+        if not self.mixed_precision_hooks:
+            for module in self.model.modules():
+                if isinstance(module, (torch.nn.GroupNorm, torch.nn.Sigmoid)):
+                    self.mixed_precision_hooks.append(module.register_forward_pre_hook(lambda module, args: (args[0].float(),)))
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            output_tc = self.model(input_tc)
+        return output_tc.float()
+
+    def forward(self, input_tc):
+        # model forward pass, uses the compiled artifact for this input shape if enabled and available
+        self.load_model()
+        if self.backend == 'onnx':
+            if self.model.available(tuple(input_tc.shape[2:])):
+                return torch.from_numpy(self.model(input_tc.cpu().numpy()))
+            return self.onnx_fallback_model()(input_tc.cpu())
+        if self.backend == 'int8':
+            return self.model(input_tc)
+        if self.tile_size is not None:
+            return self.model.forward_tiled(input_tc, self.tile_size)  # eager float32 only
+        if self.precision == 'bfloat16' and self.bfloat16_available():
+            return self.__forwardBfloat16(input_tc)  # compiled artifacts are float32 only
+        if self.use_compiled_model:
+            module = self.compiled_model(input_tc)
+            if module is not None:
+                return module(input_tc)
+        return self.model(input_tc)
+    
+    def weights_file_hash(self):
+        if self.weights_hash is None:
+            self.weights_hash = file_sha256(self.weights_file)
+        return self.weights_hash
+
+    def compiled_model_path(self, input_shape):
+        # artifact is keyed by weights hash, torch version, device and input shape
+        self.weights_file_hash()
+        shape = "x".join([str(s) for s in input_shape])
+        torch_version = torch.__version__.replace("+", "_")
+        return self.weights_file + "." + self.weights_hash[:16] + ".torch" + torch_version + "." + self.device + "." + shape + ".pt"
+    
+    def __compiledMeta(self, input_shape):
+        return {'weights_hash': self.weights_hash, 'torch_version': torch.__version__, 'device': self.device, 'input_shape': list(input_shape)}
+
+    def compiled_model(self, input_tc):
+        # load or create traced and frozen TorchScript module for the shape of input_tc, None -> fall back to eager mode 
+        input_shape = tuple(input_tc.shape)
+        if input_shape in self.compiled_models:
+            return self.compiled_models[input_shape]
+        path = self.compiled_model_path(input_shape)
+        module = None
+        stored = False
+        if os.path.exists(path):
+            try:
+                extra_files = {'meta': ''}
+                module = torch.jit.load(path, map_location=self.device, _extra_files=extra_files)
+                if json.loads(extra_files['meta']) != self.__compiledMeta(input_shape):
+                    print("Compiled model", path, "is stale, recompiling")
+                    module = None
+                stored = module is not None
+            except (RuntimeError, ValueError, OSError) as e:
+                print("Could not load compiled model", path, ":", e)
+                module = None
+        if module is None:
+            self.progress.emit(2,"Compiling model for input shape " + str(list(input_shape[2:])) + " ...")
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", torch.jit.TracerWarning)  # shape arithmetic is fixed for the traced input shape
+                    module = torch.jit.freeze(torch.jit.trace(self.model, input_tc, check_trace=False))
+            except RuntimeError as e:
+                print("Model compilation failed, using eager mode:", e)
+                module = None
+        if module is not None and not stored:
+            try:
+                # remove artifacts of older weights/torch versions for this shape
+                for old_path in glob.glob(self.weights_file + ".*." + self.device + "." + os.path.basename(path).split(".")[-2] + ".pt"):
+                    os.remove(old_path)
+                torch.jit.save(module, path, _extra_files={'meta': json.dumps(self.__compiledMeta(input_shape))})
+            except OSError as e:
+                print("Could not store compiled model", path, ":", e)
+        self.compiled_models[input_shape] = module
+        return module
+
+    def compare_precision(self, volume):
+        # agreement (Dice) and runtime of bfloat16 vs. float32 prediction of one volume 
+        precision, inference_server = self.precision, self.inference_server
+        self.inference_server = None  # both runs in-process
+        report = {'bfloat16_native': self.bfloat16_available()}
+        predictions = {}
+        for p in ('float32', 'bfloat16'):
+            self.precision = p
+            start = time.perf_counter()
+            predictions[p] = self.predict(volume)
+            report[p + '_time'] = time.perf_counter() - start
+        self.precision, self.inference_server = precision, inference_server
+        report['dice'] = dice_score(predictions['float32'], predictions['bfloat16'])
+        return report
+
+    def gaussian_weight_map(self, patch_size, sigma_scale=1/8):
+        # importance map for blending window predictions: window centers are trusted more than window borders
+        weight_map = torch.ones(patch_size)
+        for dim, size in enumerate(patch_size):
+            coords = torch.arange(size, dtype=torch.float32) - (size-1)/2
+            sigma = sigma_scale * size
+            shape = [1, 1, 1]
+            shape[dim] = -1
+            weight_map = weight_map * torch.exp(-coords**2 / (2*sigma**2)).reshape(shape)
+        weight_map = weight_map / weight_map.max()
+        return weight_map
+    
+    def window_starts(self, size, patch):
+        # evenly spread start positions of windows along one axis with at least patch_overlap overlap
+        if size <= patch:
+            return [0]
+        step = patch * (1 - self.patch_overlap)
+        num_windows = int(np.ceil((size - patch) / step)) + 1
+        return [int(round(i * (size - patch) / (num_windows - 1))) for i in range(num_windows)]
+
+    def window_slices(self, shape, patch):
+        # window positions ordered by z (last axis) first, required by PatchAggregator
+        slices = []
+        for z in self.window_starts(shape[2], patch[2]):
+            for y in self.window_starts(shape[1], patch[1]):
+                for x in self.window_starts(shape[0], patch[0]):
+                    slices.append((slice(x, x+patch[0]), slice(y, y+patch[1]), slice(z, z+patch[2])))
+        return slices
+
+    def load_volume(self, volume, value_range=None, out=None):
+        # convert numpy volume (may be a read-only/transposed view) to normalized tensor (1,1,d,h,w) on the CPU
+        # value_range: (min, max) used for normalization instead of the volume's own, e.g. of the uncropped volume
+        # out: float32 array of the volume's shape to hold the result (e.g. in shared memory)
+        lw = -700
+        uw = 2300
+        # single float32 copy in the memory layout of volume (no transposing copy, resample reads the strided tensor)
+        array = np.empty_like(volume, dtype=np.float32, order='K') if out is None else out
+        np.copyto(array, volume)
+        volume_tc = torch.from_numpy(array).unsqueeze(0).unsqueeze(0)
+        if self.windowing: 
+            # a linear rescaling of the window would be cancelled by the normalization below
+            volume_tc.clamp_(lw, uw)
+            if value_range is not None:
+                value_range = [min(max(v, lw), uw) for v in value_range]
+        if value_range is None:
+            value_range = torch.aminmax(volume_tc)
+        volume_tc.sub_(value_range[0]).div_(value_range[1] - value_range[0])  # normalize 
+        return volume_tc
+
+    def input_size(self, shape, spacing=None):
+        # model input size (inference modes 'whole'/'coarse_to_fine') of a volume of shape with spacing (mm, same axis order):
+        # output_size, or with grid_spacing the physical extent sampled at grid_spacing, rounded to multiples of grid_multiple
+        # within grid_min_size..grid_max_size. Larger grids than grid_max_voxels are coarsened by one factor on all axes first
+        if self.grid_spacing is None or spacing is None:
+            return tuple(self.output_size)
+        extent = np.array(shape) * np.abs(np.array(spacing, dtype=np.float64))
+        size = extent / np.broadcast_to(np.array(self.grid_spacing, dtype=np.float64), extent.shape)
+        size = np.maximum(size, self.grid_min_size)
+        if np.prod(size) > self.grid_max_voxels:
+            size *= (self.grid_max_voxels / np.prod(size)) ** (1 / len(size))
+        scale = 1.0
+        while True:
+            rounded = np.clip(np.round(size * scale / self.grid_multiple) * self.grid_multiple, self.grid_min_size, self.grid_max_size)
+            if np.prod(rounded) <= self.grid_max_voxels or np.all(rounded == self.grid_min_size):
+                return tuple(int(s) for s in rounded)
+            scale *= 0.98  # rounded up above grid_max_voxels
+
+    def body_box(self, volume, step=4):
+        # bounding box (slices) of the largest connected component above body_threshold plus body_margin,
+        # computed on every step-th voxel; None if no body was found
+        body = volume[::step, ::step, ::step] > self.body_threshold
+        label_img = morphology.label(body, connectivity=1)
+        if label_img.max() == 0:
+            return None
+        cluster_sizes = np.bincount(label_img.ravel())
+        cluster_sizes[0] = 0
+        indices = np.nonzero(label_img == np.argmax(cluster_sizes))
+        box = []
+        for dim, size in enumerate(volume.shape):
+            start = indices[dim].min() * step - self.body_margin
+            stop = (indices[dim].max() + 1) * step + self.body_margin
+            box.append(slice(int(max(0, start)), int(min(size, stop))))
+        return tuple(box)
+
+    def __predictWhole(self, volume_tc, input_size):
+        original_shape = volume_tc.shape
+        output_tc = self.__forwardWhole(volume_tc, input_size)
+        self.progress.emit(3,"Resampling prediction to original shape ...")
+        with self.instrumentation.stage('output_resampling'):  # includes thresholding
+            return self.resample_threshold(output_tc, original_shape, self.device)
+
+    def __forwardWhole(self, volume_tc, input_size):
+        # resample whole volume to the model input size -> probability map of the model resolution
+        self.progress.emit(1,"Resampling volume to input shape...")
+        with self.instrumentation.stage('input_resampling'):
+            volume_tc = volume_tc.to(self.device)
+            volume_tc = self.resample(volume_tc, (1, 1, *input_size),self.device)  # resample to input size of model 
+        self.progress.emit(2,"Generating prediction ...")
+        with self.instrumentation.stage('forward'):
+            return self.forward(volume_tc)
+    
+    def __predictSlidingWindow(self, volume, value_range):
+        # run model on overlapping windows at native resolution, memory is bound by window and batch size (and the mask):
+        # each window of the (swapped, cropped) volume is normalized with value_range of the whole volume
+        shape = volume.shape
+        patch = tuple(min(p, s) for p, s in zip(self.patch_size, shape))
+        slices = self.window_slices(shape, patch)
+        weight_map = self.gaussian_weight_map(patch)
+        aggregator = PatchAggregator(shape, patch, weight_map)
+        self.progress.emit(1,"Splitting volume into " + str(len(slices)) + " windows ...")
+        with self.instrumentation.stage('forward'):  # includes blending of finished windows
+            for i in range(0, len(slices), self.patch_batch_size):
+                batch_slices = slices[i:i+self.patch_batch_size]
+                self.progress.emit(2,"Generating prediction (window " + str(i+len(batch_slices)) + "/" + str(len(slices)) + ") ...")
+                batch_tc = torch.cat([self.load_volume(volume[s], value_range) for s in batch_slices]).to(self.device)
+                output_tc = self.forward(batch_tc).cpu()
+                for s, output in zip(batch_slices, output_tc):
+                    aggregator.add(s, output[0])
+        self.progress.emit(3,"Blending window predictions ...")
+        with self.instrumentation.stage('thresholding'):
+            prediction = aggregator.finish()
+        self.progress.emit(4,"Converting prediction to numpy array ...")
+        return prediction
+
+    def __predictParallel(self, volume_tc):
+        # windows of __predictSlidingWindow distributed over the worker processes, volume_tc is in shared memory
+        shape = volume_tc.shape[2:]
+        patch = tuple(min(p, s) for p, s in zip(self.patch_size, shape))
+        slices = self.window_slices(shape, patch)
+        pool = self.parallelPool()
+        self.progress.emit(1,"Distributing " + str(len(slices)) + " windows to " + str(pool.workers) + " processes ...")
+        with self.instrumentation.stage('forward'):  # includes blending
+            progress = lambda finished, total: self.progress.emit(2,"Generating prediction (window " + str(finished) + "/" + str(total) + ") ...")
+            prediction = pool.predict(patch, slices, progress)
+        self.progress.emit(4,"Converting prediction to numpy array ...")
+        return prediction
+
+    def serverClient(self):
+        if self.server_client is None:
+            from modules.InferenceServer import InferenceClient
+            self.server_client = InferenceClient(self.inference_server)
+        return self.server_client
+
+    def parallelPool(self):
+        # worker pool of inference_mode 'parallel', kept for the following predictions
+        if self.parallel_pool is None:
+            from modules.ParallelInference import ParallelInference
+            self.parallel_pool = ParallelInference(self, self.parallel_workers, self.parallel_threads)
+        return self.parallel_pool
+
+    def roi_box(self, coarse_mask, shape):
+        # bounding box (slices of the original volume) of the coarse prediction plus roi_margin, None if nothing was found
+        indices = torch.nonzero(coarse_mask)
+        if indices.shape[0] == 0:
+            return None
+        box = []
+        for dim, (size, coarse) in enumerate(zip(shape, coarse_mask.shape)):
+            scale = size / coarse
+            start = int(np.floor(indices[:, dim].min().item() * scale)) - self.roi_margin
+            stop = int(np.ceil((indices[:, dim].max().item() + 1) * scale)) + self.roi_margin
+            box.append(slice(max(0, start), min(size, stop)))
+        return tuple(box)
+
+    def roi_input_size(self, roi_shape, shape, input_size=None):
+        # model input for the region at the voxel density of whole volume prediction (input_size, default output_size),
+        # multiple of grid_multiple and at least 128 (at most input_size)
+        input_size = self.output_size if input_size is None else input_size
+        m = self.grid_multiple
+        return tuple(int(min(o, max(128, np.ceil(r * o / s / m) * m))) for r, o, s in zip(roi_shape, input_size, shape))
+
+    def __predictCoarseToFine(self, volume_tc, whole_input_size):
+        # stage 1: locate the aorta on a low resolution input, stage 2: predict only the padded bounding box
+        shape = volume_tc.shape[2:]
+        volume_tc = volume_tc.to(self.device)
+        start = time.perf_counter()
+        self.progress.emit(1,"Locating aorta (low resolution) ...")
+        with self.instrumentation.stage('coarse_pass'):
+            coarse_tc = self.forward(self.resample(volume_tc, (1, 1, *self.coarse_size), self.device))
+            box = self.roi_box(coarse_tc[0, 0] > 0.5, shape)
+            del coarse_tc
+        coarse_time = time.perf_counter() - start
+        if box is None:
+            print("Low resolution pass found no aorta, predicting whole volume")
+            box = tuple(slice(0, s) for s in shape)
+        roi_tc = volume_tc[:, :, box[0], box[1], box[2]]
+        roi_shape = roi_tc.shape[2:]
+        input_size = self.roi_input_size(roi_shape, shape, whole_input_size)
+
+        start = time.perf_counter()
+        self.progress.emit(2,"Generating prediction (region " + "x".join([str(s) for s in roi_shape]) + ") ...")
+        with self.instrumentation.stage('input_resampling'):
+            input_tc = self.resample(roi_tc, (1, 1, *input_size), self.device)
+        with self.instrumentation.stage('forward'):
+            output_tc = self.forward(input_tc)
+        del input_tc
+        fine_forward_time = time.perf_counter() - start
+        self.progress.emit(3,"Resampling prediction to original shape ...")
+        with self.instrumentation.stage('output_resampling'):  # includes thresholding
+            prediction = np.zeros(tuple(shape), dtype=np.bool_)
+            self.resample_threshold(output_tc, roi_tc.shape, self.device, out=prediction[box])
+        fine_time = time.perf_counter() - start
+
+        # forward time of whole volume prediction estimated from the region pass (runtime ~ number of input voxels),
+        # the low resolution pass is additional work, the region pass saves the forward time of all voxels outside the region
+        whole_forward_time = fine_forward_time * float(np.prod(whole_input_size) / np.prod(input_size))
+        self.report.update({'roi_box': [[b.start, b.stop] for b in box], 'roi_fraction': float(np.prod(roi_shape) / np.prod(shape)), 'roi_input_size': list(input_size),
+                            'stages': {'coarse': {'time': coarse_time, 'time_saved': -coarse_time},
+                                       'fine': {'time': fine_time, 'time_saved': whole_forward_time - fine_forward_time}},
+                            'estimated_time_saved': whole_forward_time - fine_forward_time - coarse_time})
+        print("Coarse-to-fine: low resolution pass %.1fs, region pass %.1fs (%.0f%% of the volume, saved %.1fs), total saved ~%.1fs"
+              % (coarse_time, fine_time, 100 * self.report['roi_fraction'], self.report['stages']['fine']['time_saved'], self.report['estimated_time_saved']))
+        return prediction
+
+    def run_inferrence(self, volume, spacing=None, origin=(0, 0, 0)): 
+        # spacing/origin: geometry of volume, with surface_preview the lumen surface is emitted instead of the mask (see predict_surface),
+        # not with postprocess (the surface would not be the one of the postprocessed mask)
+        if self.surface_preview and spacing is not None and self.inference_mode == 'whole' and not self.postprocess:
+            surface = self.predict_surface(volume, spacing, origin)
+            print(self.instrumentation.summary())
+            self.result.emit(surface)
+            return
+        with self.instrumentation.run(**self.__runInfo(volume)) as record:
+            if self.cache is None:
+                prediction = self.predict(volume, spacing)
+            else:
+                # same volume, weights and settings as before -> return stored prediction without running the CNN
+                self.progress.emit(0,"Looking up cached prediction ...")
+                with self.instrumentation.stage('cache_lookup'):
+                    key = self.cache.key(volume, self, spacing)
+                    prediction = self.cache.get(key)
+                record['cache_hit'] = prediction is not None
+                if prediction is None:
+                    prediction = self.predict(volume, spacing)
+                    with self.instrumentation.stage('cache_store'):
+                        self.cache.put(key, prediction)
+        print(self.instrumentation.summary())
+        self.result.emit(prediction)
+
+    def __runInfo(self, volume):
+        # settings stored with each instrumentation record
+        self.instrumentation.device = self.device
+        return {'volume_shape': list(volume.shape), 'device': str(self.device), 'backend': self.backend, 'precision': self.precision,
+                'inference_mode': self.inference_mode, 'output_size': list(self.output_size), 'grid_spacing': self.grid_spacing, 'postprocess': self.postprocess,
+                'num_threads': torch.get_num_threads()}
+
+    def predict(self, volume, spacing=None):
         # input: path to volume 
         # output: prediction in form of numpy array 
+        # spacing: voxel size (mm) of volume, sets the model input size with grid_spacing (see input_size)
         # format input
+        if self.inference_server is not None:
+            # local inference server, None if it is not running -> in-process
+            with self.instrumentation.stage('inference_server'):
+                prediction = self.serverClient().predict(volume, self, spacing)
+            if prediction is not None:
+                return prediction
+        run_info = self.__runInfo(volume)
         volume = volume.swapaxes(0, 1) 
-        lw = -700
-        uw = 2300
+        self.report = {}
         
         # inference 
+        self.pin_thread()
+        with self.instrumentation.run(**run_info) as record, torch.set_grad_enabled(False):
+            if self.inference_mode == 'sliding_window':
+                # windows are normalized one at a time, no normalized copy of the whole volume (memory independent of the scan length)
+                self.progress.emit(0,"Loading Volume ...")
+                cropped, value_range, box = self.__windowInput(volume, record)
+                self.__inputGrid(cropped.shape, spacing, record)
+                prediction = self.__predictSlidingWindow(cropped, value_range)
+                del cropped
+            else:
+                try:
+                    volume_tc, box = self.__loadInput(volume, record, shared=self.inference_mode == 'parallel')  # normalized volume in shared memory of the worker pool
+                    input_size = self.__inputGrid(volume_tc.shape[2:], spacing, record)
+                    if self.inference_mode == 'parallel':
+                        prediction = self.__predictParallel(volume_tc)
+                    elif self.inference_mode == 'coarse_to_fine':
+                        prediction = self.__predictCoarseToFine(volume_tc, input_size)
+                    else:
+                        prediction = self.__predictWhole(volume_tc, input_size)
+                finally:
+                    volume_tc = None
+                    if self.inference_mode == 'parallel' and self.parallel_pool is not None:
+                        self.parallel_pool.release()  # also after errors, the shared input would stay allocated until the next prediction
+            prediction = self.__uncrop(prediction, volume.shape, box)
+            prediction = np.transpose(prediction,(1,0,2))  
+            return self.__postprocess(prediction)
+
+    def predict_surface(self, volume, spacing, origin=(0, 0, 0)):
+        # lumen surface of volume (x,y,z) without the full resolution mask: 0.5 iso-surface of the model output (whole volume
+        # at output_size) in world coordinates origin + index * spacing, {'vertices': (n,3) float32, 'faces': (m,3) int32}.
+        # The model output is kept until deferred_prediction resamples it to the mask predict would return
+        run_info = self.__runInfo(volume)
+        volume = volume.swapaxes(0, 1)
+        self.report = {}
+        self.deferred = None
+
+        self.pin_thread()
+        with self.instrumentation.run(surface_preview=True, **run_info) as record, torch.set_grad_enabled(False):
+            volume_tc, box = self.__loadInput(volume, record)
+            cropped_shape = volume_tc.shape[2:]
+            output_tc = self.__forwardWhole(volume_tc, self.__inputGrid(cropped_shape, spacing, record))
+            del volume_tc
+            self.progress.emit(3,"Extracting surface ...")
+            with self.instrumentation.stage('surface'):
+                vertices, faces = iso_surface(output_tc[0, 0].cpu().numpy(), cropped_shape)
+                if box is not None:
+                    vertices += np.array([b.start for b in box], dtype=np.float32)
+                # (y,x,z) -> (x,y,z), the axis swap mirrors the mesh -> reverse the orientation of the faces
+                vertices = vertices[:, [1, 0, 2]] * np.asarray(spacing, dtype=np.float32) + np.asarray(origin, dtype=np.float32)
+                faces = np.ascontiguousarray(faces[:, [0, 2, 1]])
+            self.deferred = (output_tc, volume.shape, box)
+            record['surface_vertices'] = len(vertices)
+        return {'vertices': vertices, 'faces': faces}
+
+    def deferred_prediction(self):
+        # full resolution mask (x,y,z) of the last predict_surface call, None if there is none
+        if self.deferred is None:
+            return None
+        output_tc, shape, box = self.deferred
+        self.deferred = None
+        cropped_shape = shape if box is None else tuple(b.stop - b.start for b in box)
         with torch.set_grad_enabled(False):
-            self.progress.emit(0,"Loading Volume ...")
-            volume_tc = torch.from_numpy(volume.astype(np.float32)).unsqueeze(0).unsqueeze(0).to(self.device)
-            if self.windowing: 
-                volume_tc[volume_tc > uw] = uw
-                volume_tc[volume_tc < lw] = lw
-                volume_tc = volume_tc * (uw-lw)+lw
-            volume_tc = (volume_tc - torch.min(volume_tc)) / (torch.max(volume_tc) - torch.min(volume_tc))  # normalize 
-            self.progress.emit(1,"Resampling volume to input shape...")
-            original_shape = volume_tc.shape
-            volume_tc = self.resample(volume_tc, (1, 1, *self.output_size),self.device)  # resample to input size of model 
-            self.progress.emit(2,"Generating prediction ...")
-            output_tc = self.model(volume_tc)
             self.progress.emit(3,"Resampling prediction to original shape ...")
-            output_tc = self.resample(output_tc, original_shape,self.device)  
-            self.progress.emit(4,"Converting prediction to numpy array ...")
-            prediction = (output_tc[0, 0, :, :, :] > 0.5).detach().cpu().numpy()
-            prediction = np.transpose(prediction,(1,0,2))  
-            
-        # postprocessing
-        if self.postprocess:
-            self.progress.emit(5, "Postprocessing ...")
+            prediction = self.resample_threshold(output_tc, (1, 1, *cropped_shape), self.device)
+        del output_tc
+        prediction = self.__uncrop(prediction, shape, box)
+        prediction = np.transpose(prediction,(1,0,2))
+        return self.__postprocess(prediction)
+
+    def __loadInput(self, volume, record, shared=False):
+        # body crop (optional) and normalized tensor of the (swapped) volume, shared: in the input array of the worker pool
+        self.progress.emit(0,"Loading Volume ...")
+        box = self.__bodyBox(volume, record)
+        return self.__normalize(volume, box, shared), box
+
+    def __windowInput(self, volume, record):
+        # body crop (optional) of the (swapped) volume and its value range for the normalization of single windows
+        box = self.__bodyBox(volume, record)
+        with self.instrumentation.stage('normalization'):
+            value_range = (float(volume.min()), float(volume.max()))  # of the whole volume, as without cropping
+        return (volume if box is None else volume[box]), value_range, box
+
+    def __bodyBox(self, volume, record):
+        # body box of the (swapped) volume with body_crop, None: whole volume
+        if not self.body_crop:
+            return None
+        with self.instrumentation.stage('body_crop'):
+            box = self.__cropBody(volume)
+            record['body_crop_ratio'] = self.report['body_crop_ratio']
+        return box
+
+    def __normalize(self, volume, box, shared=False):
+        with self.instrumentation.stage('normalization'):
+            value_range = None if box is None else (float(volume.min()), float(volume.max()))  # of the whole volume, as without cropping
+            cropped = volume if box is None else volume[box]
+            return self.load_volume(cropped, value_range, self.parallelPool().input_array(cropped.shape) if shared else None)
+
+    def __inputGrid(self, shape, spacing, record):
+        # model input size of the (swapped, cropped) volume, its geometry is recorded with the run
+        spacing = None if spacing is None else (spacing[1], spacing[0], spacing[2])
+        input_size = self.input_size(shape, spacing)
+        grid = {'input_size': list(input_size), 'volume_shape': list(shape)}  # axes in model order (y, x, z)
+        if spacing is not None:
+            grid['volume_spacing'] = [abs(float(s)) for s in spacing]
+            grid['grid_spacing'] = [n * abs(float(s)) / i for n, s, i in zip(shape, spacing, input_size)]  # mm per model voxel
+        self.report['input_grid'] = grid
+        record['input_size'] = grid['input_size']
+        return input_size
+
+    def __uncrop(self, prediction, shape, box):
+        # map prediction of the body region back to the original extent
+        if box is None:
+            return prediction
+        full_prediction = np.zeros(shape, dtype=prediction.dtype)
+        full_prediction[box] = prediction
+        return full_prediction
+
+    def __cropBody(self, volume):
+        box = self.body_box(volume)
+        if box is None:
+            print("No body found above", self.body_threshold, "HU, predicting whole volume")
+            self.report['body_crop_ratio'] = 1.0
+            return None
+        ratio = float(np.prod([b.stop - b.start for b in box]) / np.prod(volume.shape))
+        self.report['body_box'] = [[b.start, b.stop] for b in box]
+        self.report['body_crop_ratio'] = ratio
+        print("Body crop: %.0f%% of the volume" % (100 * ratio))
+        return box
+
+    def __postprocess(self, prediction):
+        if not self.postprocess:
+            return prediction
+        self.progress.emit(5, "Postprocessing ...")
+        with self.instrumentation.stage('postprocessing'):
             prediction = prediction.astype(np.uint8)
             prediction = morphology.closing(prediction)  # close small gaps
-         # remove small clusters 
-            label_img = morphology.label(prediction,connectivity=2)
-            label_hist , _ = np.histogram(label_img, bins = np.max(label_img)+1)
-            for i in range (1, len(label_hist)):
-                cluster_size = label_hist[i]
-                if 0 < cluster_size < MIN_CLUSTER_SIZE:  
-                    prediction[label_img==i] = 0
+            prediction = remove_small_clusters(prediction, MIN_CLUSTER_SIZE)
             prediction = morphology.opening(prediction)  # remove spikes 
+        return prediction
+    
+    def batch_size(self, input_shape):
+        # number of model inputs of given spatial shape fitting into max_batch_memory
+        voxels = int(np.prod(input_shape))
+        bytes_per_voxel = CNN_BYTES_PER_VOXEL if self.tile_size is None else CNN_TILED_BYTES_PER_VOXEL
+        return max(1, int(self.max_batch_memory // (voxels * bytes_per_voxel)))
+    
+    def enqueue(self, volume, callback=None, spacing=None):
+        # add a case to the inference queue, callback(prediction) is called as soon as the case is finished
+        if callback is None:
+            callback = self.result.emit
+        self.queue.append((volume, callback, spacing))
 
-        self.result.emit(prediction)
-        
+    def run_queue(self):
+        # batched inference of all queued cases: whole volumes (whole mode) or windows of different cases 
+        # (sliding window mode) are stacked into one batch tensor, predictions are split per case
+        cases = self.queue
+        self.queue = []
+        with torch.set_grad_enabled(False):
+            if self.inference_mode == 'sliding_window':
+                self.__runQueueSlidingWindow(cases)
+            elif self.inference_mode in ('coarse_to_fine', 'parallel'):
+                for volume, callback, spacing in cases:  # region shapes differ per case / one case uses all workers -> no batching
+                    callback(self.predict(volume, spacing))
+            else:
+                self.__runQueueWhole(cases)
+    
+    def __runQueueWhole(self, cases):
+        # cases with the same model input size (output_size or adaptive grid, see input_size) are stacked into batches,
+        # body crop and normalization as in predict
+        groups = {}
+        for volume, callback, spacing in cases:
+            volume = volume.swapaxes(0, 1)
+            box = self.__bodyBox(volume, {})
+            shape = volume.shape if box is None else tuple(b.stop - b.start for b in box)
+            input_size = self.input_size(shape, None if spacing is None else (spacing[1], spacing[0], spacing[2]))
+            groups.setdefault(input_size, []).append((volume, box, callback))
+        done = 0
+        for input_size, group in groups.items():
+            batch_size = self.batch_size(input_size)
+            for i in range(0, len(group), batch_size):
+                batch_cases = group[i:i+batch_size]
+                self.progress.emit(1,"Resampling cases " + str(done+1) + "-" + str(done+len(batch_cases)) + "/" + str(len(cases)) + " to input shape ...")
+                original_shapes = []
+                batch_tc = []
+                for volume, box, _ in batch_cases:
+                    volume_tc = self.__normalize(volume, box).to(self.device)
+                    original_shapes.append(volume_tc.shape)
+                    batch_tc.append(self.resample(volume_tc, (1, 1, *input_size), self.device))
+                    del volume_tc
+                batch_tc = torch.cat(batch_tc)
+                self.progress.emit(2,"Generating prediction for " + str(len(batch_cases)) + " cases ...")
+                output_tc = self.forward(batch_tc)
+                del batch_tc
+                for j, (original_shape, (volume, box, callback)) in enumerate(zip(original_shapes, batch_cases)):
+                    self.progress.emit(3,"Resampling prediction " + str(done+j+1) + "/" + str(len(cases)) + " to original shape ...")
+                    prediction = self.resample_threshold(output_tc[j:j+1], original_shape, self.device)
+                    prediction = self.__uncrop(prediction, volume.shape, box)
+                    prediction = np.transpose(prediction,(1,0,2))
+                    callback(self.__postprocess(prediction))
+                done += len(batch_cases)
+
+    def __queueWindows(self, cases):
+        # stream of (aggregator, slices, window, case) over all cases, windows are normalized (body crop and normalization as in
+        # predict) when they are requested; case: (callback, shape, body box) with the last window, otherwise None
+        for volume, callback, _ in cases:  # native resolution, spacing not needed
+            volume = volume.swapaxes(0, 1)
+            cropped, value_range, box = self.__windowInput(volume, {})
+            shape = cropped.shape
+            patch = tuple(min(p, s) for p, s in zip(self.patch_size, shape))
+            slices = self.window_slices(shape, patch)
+            aggregator = PatchAggregator(shape, patch, self.gaussian_weight_map(patch))
+            for j, s in enumerate(slices):
+                last_window = j == len(slices) - 1
+                yield aggregator, s, self.load_volume(cropped[s], value_range), (callback, volume.shape, box) if last_window else None
+
+    def __runQueueSlidingWindow(self, cases):
+        batch_size = self.batch_size(self.patch_size)
+        windows = self.__queueWindows(cases)
+        batch = []
+        finished_cases = 0
+        while True:
+            window = next(windows, None)
+            # forward pass if batch is full, window shape changes (clipped windows) or queue is empty
+            if batch and (window is None or len(batch) == batch_size or window[2].shape != batch[0][2].shape):
+                self.progress.emit(2,"Generating prediction (case " + str(finished_cases+1) + "/" + str(len(cases)) + ") ...")
+                output_tc = self.forward(torch.cat([w[2] for w in batch]).to(self.device)).cpu()
+                for (aggregator, s, _, case), output in zip(batch, output_tc):
+                    aggregator.add(s, output[0])
+                    if case is not None:
+                        callback, shape, box = case
+                        prediction = self.__uncrop(aggregator.finish(), shape, box)
+                        prediction = np.transpose(prediction,(1,0,2))
+                        callback(self.__postprocess(prediction))
+                        finished_cases += 1
+                batch = []
+            if window is None:
+                break
+            batch.append(window)
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**24), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def dice_score(prediction_a, prediction_b):
+    # overlap of two binary masks, 1 if both are empty
+    a = prediction_a.astype(np.bool_)
+    b = prediction_b.astype(np.bool_)
+    total = np.count_nonzero(a) + np.count_nonzero(b)
+    if total == 0:
+        return 1.0
+    return float(2 * np.count_nonzero(a & b) / total)
+
+
+def remove_small_clusters(mask, min_size, connectivity=2):
+    # zero all connected components smaller than min_size voxels: one labelling pass, size table and a lookup relabel
+    label_img = morphology.label(mask, connectivity=connectivity)
+    cluster_sizes = np.bincount(label_img.ravel())
+    keep = cluster_sizes >= min_size
+    keep[0] = False  # background
+    return mask * keep[label_img]
+
+
+def crop_prediction(mask, pack=False):
+    # bounding box of the foreground for the transport to the GUI thread, optionally bit-packed
+    # {'shape': full shape, 'origin': box corner, 'size': box shape, 'data': box content, 'packed': bool}
+    crop = {'shape': mask.shape, 'origin': (0, 0, 0), 'size': (0, 0, 0), 'data': None, 'packed': pack}
+    xy = mask.any(axis=2)
+    nonzero = [np.flatnonzero(xy.any(axis=1)), np.flatnonzero(xy.any(axis=0)), np.flatnonzero(mask.any(axis=(0, 1)))]
+    if any(len(n) == 0 for n in nonzero):
+        return crop  # empty prediction
+    crop['origin'] = tuple(int(n[0]) for n in nonzero)
+    crop['size'] = tuple(int(n[-1] - n[0] + 1) for n in nonzero)
+    data = mask[tuple(slice(o, o+s) for o, s in zip(crop['origin'], crop['size']))].astype(np.bool_)
+    crop['data'] = np.packbits(data) if pack else data
+    return crop
+
+
+def paste_prediction(crop, target):
+    # write a cropped prediction into target (label buffer of the full shape), voxels outside the box are cleared
+    target[...] = 0
+    if crop['data'] is None:
+        return target
+    data = crop['data']
+    if crop['packed']:
+        data = np.unpackbits(data, count=int(np.prod(crop['size']))).reshape(crop['size'])
+    target[tuple(slice(o, o+s) for o, s in zip(crop['origin'], crop['size']))] = data
+    return target
+
+
+def iso_surface(probability, shape, level=0.5):
+    # level iso-surface of a low resolution probability map in index coordinates of shape, the map resampled to shape (see
+    # SegmentationPredictor.resample) and thresholded at level has the same boundary. Marching cubes only runs on the bounding
+    # box of the foreground, zero padded at the volume border (closed surface, as the zero padding of the resampling)
+    # -> (vertices (n,3) float32, faces (m,3) int32, oriented outwards), empty if no value exceeds level
+    vertices, faces = np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int32)
+    foreground = probability > level
+    xy = foreground.any(axis=2)
+    nonzero = [np.flatnonzero(xy.any(axis=1)), np.flatnonzero(xy.any(axis=0)), np.flatnonzero(foreground.any(axis=(0, 1)))]
+    del foreground, xy
+    if any(len(n) == 0 for n in nonzero):
+        return vertices, faces
+    box = tuple(slice(max(0, int(n[0]) - 1), min(length, int(n[-1]) + 2)) for n, length in zip(nonzero, probability.shape))
+    padding = [(int(b.start == 0), int(b.stop == length)) for b, length in zip(box, probability.shape)]
+    region = np.pad(probability[box], padding)
+    vertices, faces, _, _ = measure.marching_cubes(region, level)
+    # region index -> low resolution index -> index of shape (sample n of the resampling lies at (n + 0.5) * low / new - 0.5)
+    offset = np.array([b.start - p[0] for b, p in zip(box, padding)], dtype=np.float32)
+    scale = np.array([new / low for new, low in zip(shape, probability.shape)], dtype=np.float32)
+    vertices = ((vertices + offset + 0.5) * scale - 0.5).astype(np.float32)
+    return vertices, faces[:, [0, 2, 1]].astype(np.int32)  # marching_cubes orients the faces inwards
+
+
+class PatchAggregator():
+    """
+    Gaussian weighted blending of overlapping window predictions.
+    Windows have to be added ordered by their z-position. Finished z-slabs are thresholded right away,
+    so only one row of windows is kept in float precision (independent of the scan length).
+    """
+    def __init__(self, shape, patch, weight_map):
+        self.shape = tuple(shape)
+        self.weight_map = weight_map
+        self.prediction = np.zeros(self.shape, dtype=np.bool_)  # final binary prediction
+        self.z0 = 0                                               # z-position of the first buffer slice 
+        self.sum = torch.zeros((*self.shape[:2], patch[2]))      # weighted sum of window predictions 
+        self.weights = torch.zeros((*self.shape[:2], patch[2]))  # sum of weights 
+
+    def add(self, slices, window_prediction):
+        z_start = slices[2].start
+        if z_start > self.z0:
+            self.__flush(z_start)
+        local_slices = (slices[0], slices[1], slice(z_start-self.z0, slices[2].stop-self.z0))
+        self.sum[local_slices] += window_prediction * self.weight_map
+        self.weights[local_slices] += self.weight_map
+
+    def __flush(self, z_new):
+        # slices before z_new are not touched by any following window -> threshold and shift buffer
+        n = min(z_new - self.z0, self.sum.shape[2])
+        self.prediction[:, :, self.z0:self.z0+n] = (self.sum[:, :, :n] > 0.5 * self.weights[:, :, :n]).numpy()
+        self.sum = torch.cat((self.sum[:, :, n:], torch.zeros((*self.shape[:2], n))), dim=2)
+        self.weights = torch.cat((self.weights[:, :, n:], torch.zeros((*self.shape[:2], n))), dim=2)
+        self.z0 += n
+
+    def finish(self):
+        self.__flush(self.shape[2])
+        return self.prediction
 
 
-    
\ No newline at end of file
+if __name__ == "__main__":
+    # compare bfloat16 against float32 predictions on a cohort: python -m modules.Predictor case1.nrrd case2.nrrd ...
+    import sys
+    import types
+    import nrrd
+    predictor = SegmentationPredictor()
+    predictor.progress = types.SimpleNamespace(emit=lambda value, msg: None)  # no Qt worker attached
+    print("native bfloat16:", predictor.bfloat16_available())
+    for path in sys.argv[1:]:
+        volume, _ = nrrd.read(path)
+        report = predictor.compare_precision(volume)
+        print(os.path.basename(path), "Dice: %.4f" % report['dice'], "float32: %.1fs" % report['float32_time'], "bfloat16: %.1fs" % report['bfloat16_time'])
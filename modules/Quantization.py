@@ -0,0 +1,113 @@
+import os
+import time
+import warnings
+
+import numpy as np
+import torch
+import torch.ao.quantization as quantization
+
+# internal imports
+from modules.Predictor import SegmentationPredictor, dice_score
+
+
+def wrap_convolutions(model):
+    # place every Conv3d/ConvTranspose3d between quant/dequant stubs -> only convolutions run in INT8,
+    # GroupNorm, LeakyReLU, skip connections and sigmoid stay float
+    default_qconfig = quantization.get_default_qconfig('x86')
+    for name, child in model.named_children():
+        if isinstance(child, (torch.nn.Conv3d, torch.nn.ConvTranspose3d)):
+            wrapped = torch.nn.Sequential(quantization.QuantStub(), child, quantization.DeQuantStub())
+            if isinstance(child, torch.nn.ConvTranspose3d):
+                # per channel weight observers are not supported for transposed convolutions
+                wrapped.qconfig = quantization.QConfig(activation=default_qconfig.activation, weight=quantization.default_weight_observer)
+            else:
+                wrapped.qconfig = default_qconfig
+            setattr(model, name, wrapped)
+        else:
+            wrap_convolutions(child)
+    return model
+
+
+def quantize_model(model, calibration_inputs):
+    # static INT8 quantization of a float RUNet, activation ranges are calibrated on the given model inputs
+    torch.backends.quantized.engine = 'x86'
+    model = wrap_convolutions(model.cpu().eval())
+    quantization.prepare(model, inplace=True)
+    with torch.set_grad_enabled(False):
+        for input_tc in calibration_inputs:
+            model(input_tc)
+    quantization.convert(model, inplace=True)
+    return model
+
+
+def load_quantized_model(model, path):
+    # rebuild the quantized structure of a float RUNet and load INT8 weights saved by quantize_model
+    torch.backends.quantized.engine = 'x86'
+    model = wrap_convolutions(model.cpu().eval())
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # observers are not calibrated, quantization parameters are loaded below
+        quantization.prepare(model, inplace=True)
+        quantization.convert(model, inplace=True)
+    model.load_state_dict(torch.load(path, map_location='cpu', weights_only=True))
+    return model.eval()
+
+
+def calibration_input(predictor, volume):
+    # model input exactly as in the whole volume prediction path
+    with torch.set_grad_enabled(False):
+        volume_tc = predictor.load_volume(volume.swapaxes(0, 1))
+        return predictor.resample(volume_tc, (1, 1, *predictor.output_size), 'cpu')
+
+
+def compare_models(float_predictor, int8_predictor, volumes):
+    # speedup of the forward pass and agreement (Dice) of the final segmentations, one entry per volume
+    report = []
+    for volume in volumes:
+        input_tc = calibration_input(float_predictor, volume)
+        times = []
+        with torch.set_grad_enabled(False):
+            for predictor in (float_predictor, int8_predictor):
+                predictor.forward(input_tc)  # exclude one-time initialization (weight packing, kernel selection)
+                start = time.perf_counter()
+                predictor.forward(input_tc)
+                times.append(time.perf_counter() - start)
+        del input_tc
+        dice = dice_score(float_predictor.predict(volume), int8_predictor.predict(volume))
+        report.append({'float32_time': times[0], 'int8_time': times[1], 'speedup': times[0] / times[1], 'dice': dice})
+    return report
+
+
+if __name__ == "__main__":
+    # calibrate on local volumes, save INT8 weights and compare against the float model:
+    # python -m modules.Quantization case1.nrrd case2.nrrd ... [--output best_model497_int8]
+    import argparse
+    import types
+    import nrrd
+
+    parser = argparse.ArgumentParser(description="INT8 quantization of the RUNet convolutions")
+    parser.add_argument("volumes", nargs="+", help="nrrd volumes used for calibration and comparison")
+    parser.add_argument("--output", default=None, help="path of the quantized weights (default: <weights>_int8)")
+    args = parser.parse_args()
+
+    float_predictor = SegmentationPredictor()
+    float_predictor.device = 'cpu'
+    output = args.output if args.output is not None else float_predictor.weights_file + "_int8"
+    volumes = [nrrd.read(path)[0] for path in args.volumes]
+
+    print("Calibrating on", len(volumes), "volumes ...")
+    model = float_predictor.load_model()
+    int8_model = quantize_model(model, (calibration_input(float_predictor, volume) for volume in volumes))
+    torch.save(int8_model.state_dict(), output)
+    print("Saved INT8 weights to", output, "(%.1f MB)" % (os.path.getsize(output) / 1024**2))
+
+    # fresh float model, quantization modified the loaded one in place
+    float_predictor.model = None
+    int8_predictor = SegmentationPredictor()
+    int8_predictor.backend = 'int8'
+    int8_predictor.quantized_weights_file = output
+    for predictor in (float_predictor, int8_predictor):
+        predictor.progress = types.SimpleNamespace(emit=lambda value, msg: None)  # no Qt worker attached
+    report = compare_models(float_predictor, int8_predictor, volumes)
+    for path, entry in zip(args.volumes, report):
+        print(os.path.basename(path), "speedup: %.2fx" % entry['speedup'], "(%.1fs -> %.1fs)" % (entry['float32_time'], entry['int8_time']), "Dice: %.4f" % entry['dice'])
+    print("mean speedup: %.2fx" % np.mean([entry['speedup'] for entry in report]), "mean Dice: %.4f" % np.mean([entry['dice'] for entry in report]))
@@ -6,8 +6,9 @@ import torch.nn.functional as F
 # model from https://github.com/MWod/SEGA_MW_2023/tree/main -> assembled methods from runet, and building blocks 
 
 class RUNet(torch.nn.Module):
-    def __init__(self, input_channels, output_channels, blocks_per_encoder_channel, blocks_per_decoder_channel, img_size=None, number_of_output_channels=1, use_sigmoid=True):
+    def __init__(self, input_channels, output_channels, blocks_per_encoder_channel, blocks_per_decoder_channel, img_size=None, number_of_output_channels=1, use_sigmoid=True, tile_size=None):
         super(RUNet, self).__init__()    
+        self.tile_size = tile_size  # None: run whole tensors, else run the full resolution stages in slabs of tile_size slices (see forward_tiled)
         self.input_channels = input_channels
         self.output_channels = output_channels
         self.blocks_per_encoder_channel = blocks_per_encoder_channel
@@ -36,17 +37,165 @@ class RUNet(torch.nn.Module):
         if self.image_size is not None and (d, h, w) != (self.image_size[0], self.image_size[1], self.image_size[2]):
             x = F.interpolate(x, self.image_size, mode='trilinear')
             
-        embeddings = self.encoder(x)
-        decoded = self.decoder(embeddings)
-        if decoded.shape != x.shape:
-            decoded = self.decoder.pad(decoded, x)
-        result = self.last_layer(decoded)
+        if self.tile_size is not None:
+            result = self.forward_tiled(x)
+        else:
+            embeddings = self.encoder(x)
+            decoded = self.decoder(embeddings)
+            if decoded.shape != x.shape:
+                decoded = self.decoder.pad(decoded, x)
+            result = self.last_layer(decoded)
         
         if self.image_size is not None and (d, h, w) != (self.image_size[0], self.image_size[1], self.image_size[2]):
             result = F.interpolate(result, (d, h, w), mode='trilinear')
         return result
-    
-    
+
+    def forward_tiled(self, x, tile_size=None):
+        # memory capped execution: convolutions of the first encoder/decoder stage and the last layer are computed in slabs 
+        # along dim 2 (with halos of the receptive field) into preallocated outputs, GroupNorm and LeakyReLU are applied in 
+        # place on the assembled tensors (statistics over the whole volume as in forward). The slabs of a convolution
+        # may use other kernels than the whole tensor, results match forward within float32 rounding (sigmoid output
+        # max abs difference ~1e-4 with random weights, checked with: python -m benchmarks.tiling)
+        tile_size = self.tile_size if tile_size is None else tile_size
+        embeddings = self.encoder.forward_tiled(x, tile_size)
+        decoded = self.decoder.forward_tiled(embeddings, tile_size)
+        if decoded.shape[2:] != x.shape[2:]:
+            decoded = self.decoder.pad(decoded, x)
+        result = None
+        for start in range(0, decoded.shape[2], tile_size):
+            slab = self.last_layer(decoded[:, :, start:start+tile_size])
+            if result is None:
+                result = slab.new_empty((*slab.shape[:2], decoded.shape[2], *slab.shape[3:]))
+            result[:, :, start:start+slab.shape[2]] = slab
+        return result
+
+
+def tiled_conv(conv, source, depth, tile_size, out=None):
+    # Conv3d/ConvTranspose3d on the input given by source(start, stop) (slices along dim 2 of an input with depth slices),
+    # output is computed in slabs of tile_size slices; with out the result is added to out
+    k, s, p = conv.kernel_size[0], conv.stride[0], conv.padding[0]
+    transposed = isinstance(conv, torch.nn.ConvTranspose3d)
+    if transposed:
+        out_depth = (depth - 1) * s - 2 * p + k + conv.output_padding[0]
+    else:
+        out_depth = (depth + 2 * p - k) // s + 1
+    padding = (0, conv.padding[1], conv.padding[2])
+    accumulate = out is not None
+    for o0 in range(0, out_depth, tile_size):
+        o1 = min(o0 + tile_size, out_depth)
+        if transposed:
+            # inputs i contribute to outputs i*s - p + [0, k)
+            i0 = max(0, -((p - k + 1 + o0) // -s))
+            i1 = min(depth, (o1 - 1 + p) // s + 1)
+            slab = F.conv_transpose3d(source(i0, i1), conv.weight, conv.bias, (s, *conv.stride[1:]), padding,
+                                      (0, *conv.output_padding[1:]), conv.groups, conv.dilation)
+            q0 = o0 - i0 * s + p
+            slab = slab[:, :, q0:q0 + o1 - o0]
+            if slab.shape[2] < o1 - o0:  # output_padding at the end
+                slab = F.pad(slab, (0, 0, 0, 0, 0, o1 - o0 - slab.shape[2]))
+        else:
+            # output o sees inputs o*s - p + [0, k), zero padding outside of the input
+            i0, i1 = o0 * s - p, (o1 - 1) * s - p + k
+            slab = source(max(0, i0), min(depth, i1))
+            if i0 < 0 or i1 > depth:
+                slab = F.pad(slab, (0, 0, 0, 0, max(0, -i0), max(0, i1 - depth)))
+            slab = F.conv3d(slab, conv.weight, conv.bias, (s, *conv.stride[1:]), padding, conv.dilation, conv.groups)
+        if out is None:
+            out = slab.new_empty((*slab.shape[:2], out_depth, *slab.shape[3:]))
+        if accumulate:
+            out[:, :, o0:o1] += slab
+        else:
+            out[:, :, o0:o1] = slab
+        del slab
+    return out
+
+
+def group_norm_(x, norm):
+    # GroupNorm with one channel per group (as in RUNet) in place
+    mean_var = torch.var_mean(x, dim=(2, 3, 4), unbiased=False, keepdim=True)
+    scale = torch.rsqrt(mean_var[0] + norm.eps) * norm.weight.reshape(1, -1, 1, 1, 1)
+    x.sub_(mean_var[1]).mul_(scale).add_(norm.bias.reshape(1, -1, 1, 1, 1))
+    return x
+
+
+def run_tiled(layer, source, depth, tile_size):
+    # run an encoder/decoder stage (ResidualBlocks, convolution, GroupNorm, LeakyReLU) with tiled convolutions
+    x = None
+    for module in layer:
+        if isinstance(module, ResidualBlock):
+            x = module.forward_tiled(source, depth, tile_size)
+        elif isinstance(module, (torch.nn.Conv3d, torch.nn.ConvTranspose3d)):
+            x = tiled_conv(module, source, depth, tile_size)
+        elif isinstance(module, GroupNormLeakyReLU):
+            x = F.leaky_relu_(group_norm_(x, module), module.negative_slope)
+        elif isinstance(module, torch.nn.GroupNorm) and module.num_groups == module.num_channels:
+            x = group_norm_(x, module)
+        elif isinstance(module, torch.nn.Identity):
+            continue
+        elif isinstance(module, torch.nn.LeakyReLU):
+            x = F.leaky_relu_(x, module.negative_slope)
+        else:
+            x = module(source(0, depth))
+        source, depth = slab_source(x), x.shape[2]
+    return x
+
+
+def slab_source(x):
+    return lambda start, stop: x[:, :, start:stop]
+
+
+def group_norm_leaky_relu(x, weight, bias, eps: float, negative_slope: float):
+    # GroupNorm with one channel per group followed by LeakyReLU, compiled into one kernel by fuse_for_inference
+    var, mean = torch.var_mean(x, dim=(2, 3, 4), unbiased=False, keepdim=True)
+    scale = torch.rsqrt(var + eps) * weight.reshape(1, -1, 1, 1, 1)
+    y = (x - mean) * scale + bias.reshape(1, -1, 1, 1, 1)
+    return x.copy_(torch.where(y > 0, y, y * negative_slope))
+
+
+class GroupNormLeakyReLU(torch.nn.GroupNorm):
+    """
+    Inference-only fusion of GroupNorm (one channel per group) and the following LeakyReLU, created by fuse_for_inference.
+    Keeps the parameters of the GroupNorm (same state dict) and overwrites its input (only fused after convolutions).
+    The compiled kernel is shared by all instances and used for large activations. For small activations, without a working
+    torch.compile (no C++ compiler) and for tracing/export, gradients, other dtypes and devices group_norm and leaky_relu_
+    run as before.
+    """
+    kernel = None       # compiled group_norm_leaky_relu (dynamic shapes)
+    compiled = None     # None: not tried yet, False: compilation failed
+    min_numel = 2**21   # smaller activations run faster with the native kernels (call overhead of the compiled kernel)
+
+    def __init__(self, norm, activation):
+        super(GroupNormLeakyReLU, self).__init__(norm.num_groups, norm.num_channels, norm.eps, norm.affine)
+        self.weight, self.bias = norm.weight, norm.bias
+        self.negative_slope = activation.negative_slope
+
+    def forward(self, x):
+        if (GroupNormLeakyReLU.compiled is not False and x.numel() >= self.min_numel and x.dtype == torch.float32 and x.device.type == 'cpu'
+                and not torch.is_grad_enabled() and not torch.jit.is_tracing() and not torch.compiler.is_compiling()):
+            try:
+                if GroupNormLeakyReLU.kernel is None:
+                    GroupNormLeakyReLU.kernel = torch.compile(group_norm_leaky_relu, dynamic=True)
+                result = GroupNormLeakyReLU.kernel(x, self.weight, self.bias, self.eps, self.negative_slope)
+                GroupNormLeakyReLU.compiled = True
+                return result
+            except Exception as e:  # compiler missing or unsupported platform
+                print("Fused GroupNorm/LeakyReLU not available:", e)
+                GroupNormLeakyReLU.compiled = False
+        return F.leaky_relu_(F.group_norm(x, self.num_groups, self.weight, self.bias, self.eps), self.negative_slope)
+
+
+def fuse_for_inference(model):
+    # rewrite convolution -> GroupNorm -> LeakyReLU chains of all Sequentials into convolution -> GroupNormLeakyReLU -> Identity
+    # (eval mode only, parameter names unchanged); the convolutions themselves are left to the backend (mkldnn)
+    for child in model.children():
+        if isinstance(child, torch.nn.Sequential):
+            for i in range(1, len(child) - 1):
+                conv, norm, activation = child[i - 1], child[i], child[i + 1]
+                if (isinstance(conv, (torch.nn.Conv3d, torch.nn.ConvTranspose3d)) and type(norm) is torch.nn.GroupNorm and norm.affine
+                        and norm.num_groups == norm.num_channels and isinstance(activation, torch.nn.LeakyReLU)):
+                    child[i], child[i + 1] = GroupNormLeakyReLU(norm, activation), torch.nn.Identity()
+        fuse_for_inference(child)
+    return model
 
 
 class RUNetEncoder(torch.nn.Module):
@@ -82,6 +231,13 @@ class RUNetEncoder(torch.nn.Module):
             embeddings.append(cx)
         return embeddings
 
+    def forward_tiled(self, x, tile_size):
+        # full resolution stage tiled, deeper stages whole
+        embeddings = [run_tiled(self.encoder_0, slab_source(x), x.shape[2], tile_size)]
+        for i in range(1, self.num_channels):
+            embeddings.append(getattr(self, f"encoder_{i}")(embeddings[-1]))
+        return embeddings
+
 class RUNetDecoder(torch.nn.Module):
     def __init__(self, input_channels, output_channels, blocks_per_channel):
         super(RUNetDecoder, self).__init__()
@@ -122,6 +278,19 @@ class RUNetDecoder(torch.nn.Module):
             else:
                 cx = getattr(self, f"decoder_{i}")(torch.cat((self.pad(cx, embeddings[i]), embeddings[i]), dim=1))       
         return cx
+
+    def forward_tiled(self, embeddings, tile_size):
+        # deeper stages whole, the first stage tiled with its concatenated input assembled per slab
+        cx = embeddings[-1]
+        for i in range(self.num_channels - 1, 0, -1):
+            if i == self.num_channels - 1:
+                cx = getattr(self, f"decoder_{i}")(embeddings[i])
+            else:
+                cx = getattr(self, f"decoder_{i}")(torch.cat((self.pad(cx, embeddings[i]), embeddings[i]), dim=1))
+        if cx.shape[2:] != embeddings[0].shape[2:]:
+            cx = self.pad(cx, embeddings[0])
+        source = lambda start, stop: torch.cat((cx[:, :, start:stop], embeddings[0][:, :, start:stop]), dim=1)
+        return run_tiled(self.decoder_0, source, cx.shape[2], tile_size)
     
     
         
@@ -143,4 +312,9 @@ class ResidualBlock(torch.nn.Module):
         )
 
     def forward(self, x : torch.Tensor):
-        return self.module(x) + self.conv(x)
\ No newline at end of file
+        return self.module(x) + self.conv(x)
+
+    def forward_tiled(self, source, depth, tile_size):
+        # same as forward with tiled convolutions, the residual branch is added slab by slab
+        x = run_tiled(self.module, source, depth, tile_size)
+        return tiled_conv(self.conv[0], source, depth, tile_size, out=x)
\ No newline at end of file
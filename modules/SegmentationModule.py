@@ -5,7 +5,7 @@ import nrrd
 import numpy as np
 import vtk
 from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-from PyQt6.QtCore import pyqtSignal, Qt,  QObject, QThread
+from PyQt6.QtCore import pyqtSignal, Qt,  QObject, QThread, QTimer
 from PyQt6.QtGui import QAction 
 from PyQt6.QtWidgets import (
     QGridLayout,
@@ -23,7 +23,6 @@ from PyQt6.QtWidgets import (
 
 # internal imports 
 from modules.Interactors import ImageSliceInteractor, IsosurfaceInteractor
-from modules.Predictor import SegmentationPredictor
 from defaults import *
 
 
@@ -31,12 +30,14 @@ class SegmentationModule(QWidget):
     new_segmentation = pyqtSignal()  
     new_models = pyqtSignal()
     data_modified = pyqtSignal()
+    save_resumed = pyqtSignal()      # the label map a save waited for is ready, the save is repeated
     def __init__(self, parent=None):
         super().__init__(parent)
           
         # state 
         self.patient_dict = None
-        self.predictor = SegmentationPredictor() # global wrapper for pytorch execution
+        self.predictor = None            # global wrapper for pytorch execution, created on first use (imports torch)
+        self.predictor_loading = False   # True while the CNN is loaded in the background
         self.image = None                # underlying CTA volume image
         self.image_data = None           # numpy array of raw image scalar data
         self.label_map = None            # segmentation label map
@@ -44,6 +45,10 @@ class SegmentationModule(QWidget):
         self.threshold_img = None        # image to display threshold on current slice
         self.volume_file = False         # path to CTA volume file
         self.lumen_pending = True        # True if no lumen pixels exist yet
+        self.surface_preview = False     # True while the CNN surface preview is shown, the label map is computed on demand
+        self.label_map_computing = False # True while the label map of the surface preview is computed in the background
+        self.label_map_source = None     # label map the computed one belongs to (results for a replaced label map are dropped)
+        self.label_map_action = None     # edit/save continued when the label map of the surface preview is ready
         self.model_camera_pending = True # True if camera of model_view has not been set yet
         self.editing_active = False      # True if label map editing is active
         self.brush_size = 15             # size of brush on label map
@@ -60,7 +65,8 @@ class SegmentationModule(QWidget):
         self.slice_view_slider.setEnabled(False)
 
         self.model_view = IsosurfaceInteractor(self)
-        self.CNN_button = QPushButton("New Segmentation: Initialize with CNN") 
+        self.CNN_button_text = "New Segmentation: Initialize with CNN"
+        self.CNN_button = QPushButton(self.CNN_button_text) 
         self.CNN_button.setEnabled(False)
         
         # QT UI
@@ -144,7 +150,7 @@ class SegmentationModule(QWidget):
         
         # vtk objects
         self.lumen_outline_actor3D, self.lumen_outline_actor2D = self.__createOutlineActors(
-            self.model_view.smoother_lumen.GetOutputPort(), COLOR_LUMEN_DARK, COLOR_LUMEN)  # 3D -> position indicator on surface
+            self.model_view.surface_lumen.GetOutputPort(), COLOR_LUMEN_DARK, COLOR_LUMEN)  # 3D -> position indicator on surface
         self.__setupLUT()  # setup lookup table to display masks and threshold 
         self.__setupEditingPipeline()
         
@@ -153,6 +159,10 @@ class SegmentationModule(QWidget):
         self.slice_view.Start()
         self.model_view.Initialize()
         self.model_view.Start()
+
+        # load CNN in the background as soon as the event loop is idle
+        if CNN_WARMUP:
+            QTimer.singleShot(0, self.warmUpPredictor)
         
 
     def __createOutlineActors(self, output_port, color3D, color2D):
@@ -285,6 +295,10 @@ class SegmentationModule(QWidget):
 
     def loadVolumeSeg(self, volume_file, seg_file, is_new_file=True):
         self.old_threshold = None
+        self.surface_preview = False
+        self.label_map_action = None
+        if self.predictor is not None:
+            self.predictor.deferred = None
         if volume_file:
             # load image volume if it is new
             if is_new_file:
@@ -292,7 +306,7 @@ class SegmentationModule(QWidget):
                 self.__loadImageData()
                 self.brush_size = abs(self.image.GetSpacing()[0]*self.brush_size)
                 self.toolbar_edit.setEnabled(True)
-                self.CNN_button.setEnabled(True)
+                self.updateCNNButton()
                 self.slice_view_slider.setRange(
                     self.slice_view.min_slice,
                     self.slice_view.max_slice
@@ -323,8 +337,8 @@ class SegmentationModule(QWidget):
                 self.label_map.SetDimensions(self.image.GetDimensions())
                 self.label_map.SetSpacing(self.image.GetSpacing())
                 self.label_map.SetOrigin(self.image.GetOrigin())
-                self.label_map_data = np.zeros(self.label_map.GetDimensions(), dtype=np.uint8)
-                vtk_data_array = numpy_to_vtk(self.label_map_data.ravel(order='F'))
+                self.label_map_data = np.zeros(self.label_map.GetDimensions(), dtype=np.uint8, order='F')
+                vtk_data_array = numpy_to_vtk(self.label_map_data.ravel(order='F'))  # no copy, VTK scalars share the buffer
                 self.label_map.GetPointData().SetScalars(vtk_data_array)
                 self.masks_color_mapped.SetInputData(self.label_map)
                 self.model_view.renderer.RemoveActor(self.lumen_outline_actor3D)
@@ -351,7 +365,7 @@ class SegmentationModule(QWidget):
             if self.editing_active:
                 self.edit(False)
             self.toolbar_edit.setEnabled(False)
-            self.CNN_button.setEnabled(False)
+            self.updateCNNButton()
             self.slice_view_slider.setEnabled(False)
             self.model_view.renderer.RemoveActor(self.lumen_outline_actor3D)
             self.slice_view.renderer.RemoveActor(self.lumen_outline_actor2D)
@@ -364,14 +378,68 @@ class SegmentationModule(QWidget):
         self.loadVolumeSeg(patient_dict["volume"],patient_dict["seg"])
        
 
-    def return_prediction(self, prediction_label_map):
-        # update the label map
-        x0, y0, z0 = prediction_label_map.shape  
-        self.label_map_data[:x0,:y0,:z0] = prediction_label_map  
-        vtk_data_array = numpy_to_vtk(self.label_map_data.ravel(order='F'))
-        self.label_map.GetPointData().SetScalars(vtk_data_array)
-        self.lumen_pending = self.model_view.updateScene(self.label_map_data, self.label_map)
+    def return_prediction(self, prediction_crop):
+        # update the label map: write the bounding box of the prediction into the label buffer
+        from modules.Predictor import paste_prediction
+        paste_prediction(prediction_crop, self.label_map_data)
+        self.__labelMapModified()
+        self.surface_preview = False
+        self.lumen_pending = self.model_view.updateScene(self.label_map_data, self.label_map, prediction_crop['data'] is not None)
+        self.__updateLumenActors()
+
+    def return_surface(self, surface):
+        # CNN surface preview: show the mesh of the model resolution output, the label map stays empty until it is needed
+        self.label_map_data[...] = 0
+        self.__labelMapModified()
+        self.surface_preview = True
+        self.lumen_pending = self.model_view.showSurface(surface['vertices'], surface['faces'])
+        self.__updateLumenActors()
+
+    def __resolveSurfacePreview(self, action):
+        # editing and saving need the label map of the previewed prediction: True if it exists, otherwise it is computed
+        # in a separate thread and action is called once it is pasted (False, the caller returns and the GUI stays responsive)
+        if not self.surface_preview:
+            return True
+        self.label_map_action = action  # the latest request is continued
+        if self.label_map_computing:
+            return False
+        self.label_map_computing = True
+        self.toolbar_edit.setEnabled(False)
+        self.CNN_button.setEnabled(False)
 
+        self.label_map_thread = QThread()
+        self.label_map_worker = Label_Map_Worker()
+        self.label_map_worker.predictor = self.predictor
+        self.label_map_worker.moveToThread(self.label_map_thread)
+        self.label_map_source = self.label_map
+
+        self.label_map_worker.progress[int,str].connect(lambda value, message: self.ui_statusbar.showMessage(message))
+        self.label_map_worker.result.connect(self.returnLabelMap)
+        self.label_map_worker.finished.connect(self.label_map_thread.quit)
+        self.label_map_worker.finished.connect(self.label_map_worker.deleteLater)
+
+        self.label_map_thread.started.connect(self.label_map_worker.run)
+        self.label_map_thread.finished.connect(self.label_map_thread.deleteLater)
+        self.label_map_thread.finished.connect(self.labelMapFinished)
+        self.label_map_thread.start()
+        return False
+
+    def returnLabelMap(self, prediction_crop):
+        # label map of the surface preview, dropped if the patient was reloaded (discard) or changed in the meantime
+        if self.label_map is self.label_map_source and self.surface_preview:
+            self.return_prediction(prediction_crop)
+
+    def labelMapFinished(self):
+        self.label_map_computing = False
+        self.label_map_source = None
+        self.toolbar_edit.setEnabled(self.image is not None)
+        self.updateCNNButton()
+        self.ui_statusbar.clearMessage()
+        action, self.label_map_action = self.label_map_action, None
+        if action is not None and not self.surface_preview:
+            action()
+
+    def __updateLumenActors(self):
         # update scene actors
         if self.lumen_pending:
             self.model_view.renderer.RemoveActor(self.lumen_outline_actor3D)
@@ -385,6 +453,64 @@ class SegmentationModule(QWidget):
         self.model_view.GetRenderWindow().Render()
             
 
+    def __labelMapModified(self):
+        # label_map_data is the buffer of the VTK scalars -> flag the change instead of rebuilding the array
+        scalars = self.label_map.GetPointData().GetScalars()
+        if vtk_to_numpy(scalars).ctypes.data != self.label_map_data.ctypes.data:
+            scalars = numpy_to_vtk(self.label_map_data.ravel(order='F'))
+            self.label_map.GetPointData().SetScalars(scalars)
+        scalars.Modified()
+        self.label_map.Modified()
+
+    def getPredictor(self):
+        # create predictor on first use, weights are loaded by the prediction thread if not warmed up
+        if self.predictor is None:
+            from modules.Predictor import SegmentationPredictor
+            self.predictor = SegmentationPredictor()
+        return self.predictor
+
+    def warmUpPredictor(self):
+        # import torch, load weights and run a dummy prediction in a background thread
+        if self.predictor is not None and (self.predictor.model is not None or self.predictor.server_ready):
+            return
+        self.predictor_loading = True
+        self.updateCNNButton()
+
+        self.warmup_thread = QThread()
+        self.warmup_worker = Warmup_Worker()
+        self.warmup_worker.predictor = self.predictor
+        self.warmup_worker.moveToThread(self.warmup_thread)
+
+        self.warmup_worker.ready.connect(self.predictorReady)
+        self.warmup_worker.finished.connect(self.warmup_thread.quit)
+        self.warmup_worker.finished.connect(self.warmup_worker.deleteLater)
+
+        self.warmup_thread.started.connect(self.warmup_worker.run)
+        self.warmup_thread.finished.connect(self.warmup_thread.deleteLater)
+        self.warmup_thread.start(QThread.Priority.LowestPriority)
+
+    def predictorReady(self, predictor):
+        if self.predictor is None:
+            self.predictor = predictor
+        self.predictor_loading = False
+        self.updateCNNButton()
+
+    def updateCNNButton(self):
+        # show if CNN is loading/ready, button only usable with image and no background loading
+        if self.predictor_loading:
+            self.CNN_button.setText(self.CNN_button_text + " (loading CNN ...)")
+        elif self.predictor is not None and self.predictor.model is not None:
+            self.CNN_button.setText(self.CNN_button_text + " (CNN ready " + SYM_YES + ")")
+        elif self.predictor is not None and self.predictor.server_ready:
+            self.CNN_button.setText(self.CNN_button_text + " (CNN server " + SYM_YES + ")")
+        else:
+            self.CNN_button.setText(self.CNN_button_text)
+        self.CNN_button.setEnabled(self.image is not None and not self.predictor_loading and not self.label_map_computing)
+
+    def showPredictionRecord(self):
+        # stage timings and peak memory of the finished prediction 
+        self.ui_statusbar.showMessage(self.predictor.instrumentation.summary(), 30000)
+
     def reportProgress(self,progress_val, progress_msg):
         self.pbar.setValue(progress_val)
         self.pbar.setFormat(progress_msg + " (%p%)")
@@ -408,12 +534,17 @@ class SegmentationModule(QWidget):
             # move segmentation to a separate thread (prevent freezing)
             self.thread = QThread()
             self.worker = Prediction_Worker()
-            self.worker.predictor = self.predictor
-            self.worker.volume = np.copy(self.image_data)
+            self.worker.predictor = self.getPredictor()
+            self.worker.spacing = self.image.GetSpacing()
+            self.worker.origin = self.image.GetOrigin()
+            volume = self.image_data.view()  # no copy of the display buffer, the predictor only reads it
+            volume.flags.writeable = False
+            self.worker.volume = volume
             self.worker.moveToThread(self.thread)
             
             self.worker.progress[int,str].connect(self.reportProgress)
             self.worker.result.connect(self.return_prediction)
+            self.worker.surface.connect(self.return_surface)
             self.worker.finished.connect(self.thread.quit)
             self.worker.finished.connect(self.worker.deleteLater)
             
@@ -421,7 +552,8 @@ class SegmentationModule(QWidget):
             self.thread.finished.connect(self.thread.deleteLater)
             self.thread.finished.connect(lambda:self.ui_statusbar.removeWidget(self.pbar))
             self.thread.finished.connect(lambda:self.toolbar_edit.setEnabled(True))
-            self.thread.finished.connect(lambda:self.CNN_button.setEnabled(True))
+            self.thread.finished.connect(self.updateCNNButton)
+            self.thread.finished.connect(self.showPredictionRecord)
             self.thread.start()
         
             
@@ -455,6 +587,9 @@ class SegmentationModule(QWidget):
         return circle
     
     def edit(self, on:bool):
+        if on and not self.__resolveSurfacePreview(self.resumeEdit):
+            self.toolbar_edit.setChecked(False)  # editing starts when the label map is ready
+            return
         self.editing_active = on
         # activate editing
         if on: 
@@ -515,6 +650,10 @@ class SegmentationModule(QWidget):
             self.model_view.GetRenderWindow().Render()
             self.editing_active = False 
 
+    def resumeEdit(self):
+        self.toolbar_edit.setChecked(True)
+        self.edit(True)
+
     def brushSizeChanged(self, brush_size): 
         # change size of drawing on label map
         x_spacing = abs(self.image.GetSpacing()[0]) # can be negative
@@ -752,6 +891,8 @@ class SegmentationModule(QWidget):
         if not os.path.exists(os.path.join(base_path,"models")):
             os.makedirs(os.path.join(base_path,"models"))
         path_lumen = os.path.join(base_path, "models", patient_ID + ".stl")
+        if not self.__resolveSurfacePreview(self.save_resumed.emit):
+            return True  # label map not ready yet, saved again with save_resumed
 
         x_dim, y_dim, z_dim = self.label_map.GetDimensions()
         if x_dim == 0 or y_dim == 0 or z_dim == 0:
@@ -784,7 +925,7 @@ class SegmentationModule(QWidget):
 
         # save models
         writer = vtk.vtkSTLWriter()
-        lumen = self.model_view.smoother_lumen.GetOutput()
+        lumen = self.model_view.surface_lumen.GetOutput()
         if lumen.GetNumberOfPoints() > 0:
             writer.SetFileName(path_lumen)
             writer.SetInputData(lumen)
@@ -800,16 +941,68 @@ class SegmentationModule(QWidget):
 
 
 
+class Warmup_Worker(QObject):
+    finished = pyqtSignal()
+    ready = pyqtSignal(object)
+    predictor = None
+
+    def run(self):
+        # create predictor (imports torch) and load CNN off the GUI thread 
+        # the button is released in any case, a failed warm-up fails again (with message) on prediction
+        try:
+            from modules.Predictor import SegmentationPredictor
+            if self.predictor is None:
+                self.predictor = SegmentationPredictor()
+            self.predictor.warm_up()
+        except Exception as e:
+            print("CNN warm-up failed:", repr(e))
+        finally:
+            self.ready.emit(self.predictor)
+            self.finished.emit()
+
+
+class Label_Map_Worker(QObject):
+    finished = pyqtSignal()
+    progress = pyqtSignal(int,str)
+    result = pyqtSignal(object)  # bounding box crop of the mask
+    predictor = None
+
+    def run(self):
+        # full resolution mask of the surface preview (resampling, postprocessing) off the GUI thread
+        from modules.Predictor import crop_prediction
+        self.predictor.progress = self.progress
+        try:
+            prediction = self.predictor.deferred_prediction()
+            if prediction is not None:
+                self.result.emit(crop_prediction(prediction))
+        finally:
+            self.finished.emit()
+
+
 class Prediction_Worker(QObject):
     finished = pyqtSignal()
     progress = pyqtSignal(int,str)
-    result = pyqtSignal(object)
+    predicted = pyqtSignal(object)  # full size mask (prediction thread)
+    result = pyqtSignal(object)     # bounding box crop of the mask (to the GUI thread)
+    surface = pyqtSignal(object)    # lumen mesh of the surface preview (predictor.surface_preview)
     predictor = None
     volume = None
+    spacing = None
+    origin = (0, 0, 0)
+    pack_prediction = False
 
     def run(self):
         # predict with CNN and report progress
         self.predictor.progress = self.progress
-        self.predictor.result = self.result
-        self.predictor.run_inferrence(self.volume)  
+        self.predictor.result = self.predicted
+        self.predicted.connect(self.cropPrediction)
+        self.predictor.run_inferrence(self.volume, self.spacing, self.origin)  
         self.finished.emit()
+
+    def cropPrediction(self, prediction):
+        # crop in the prediction thread, the GUI thread only copies the segmented region
+        from modules.Predictor import crop_prediction
+        if isinstance(prediction, dict):
+            self.surface.emit(prediction)  # already small, no mask
+            return
+        self.result.emit(crop_prediction(prediction, self.pack_prediction))
@@ -0,0 +1,102 @@
+import multiprocessing
+import os
+
+import torch
+
+# internal imports
+from modules.Predictor import SegmentationPredictor, file_sha256
+
+# weights prepared for memory mapping: the model_state_dict of a training checkpoint saved uncompressed next to it with the
+# sha256 of the checkpoint, SegmentationPredictor maps it on CPU (page cache shared by all predictor processes of a host)
+# if it was converted from the current checkpoint:
+# python -m modules.SharedWeights [best_model497]           (convert)
+# python -m modules.SharedWeights --check 4                 (resident memory of 4 worker processes, mapped vs. private weights)
+
+
+def mmap_weights_path(weights_file):
+    return weights_file + ".mmap"
+
+
+def convert_checkpoint(weights_file, output=None):
+    # extract the model weights (no optimizer state) as contiguous float tensors in torch's zip format (uncompressed, aligned)
+    output = mmap_weights_path(weights_file) if output is None else output
+    trained = torch.load(weights_file, map_location='cpu', weights_only=True)
+    state_dict = trained['model_state_dict'] if 'model_state_dict' in trained else trained
+    state_dict = {name: tensor.contiguous() for name, tensor in state_dict.items()}
+    torch.save({'source_sha256': file_sha256(weights_file), 'model_state_dict': state_dict}, output)
+    return output
+
+
+def load_mmap_weights(path, source_hash):
+    # memory mapped model weights, None if they were not converted from the checkpoint with sha256 source_hash
+    # (replaced checkpoint or file of an older conversion)
+    converted = torch.load(path, mmap=True, map_location='cpu', weights_only=True)
+    if not isinstance(converted, dict) or converted.get('source_sha256') != source_hash:
+        return None
+    return converted['model_state_dict']
+
+
+def memory_usage():
+    # resident (Rss), proportional (Pss: shared pages divided by the number of processes sharing them) and shared memory in bytes
+    usage = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == "kB":
+                usage[fields[0].rstrip(":")] = int(fields[1]) * 1024
+    return {'rss': usage.get('Rss'), 'pss': usage.get('Pss'), 'shared': usage.get('Shared_Clean', 0) + usage.get('Shared_Dirty', 0)}
+
+
+def worker(weights_file, use_mmap, warm_up, barrier, queue):
+    predictor = SegmentationPredictor()
+    predictor.device = 'cpu'
+    predictor.weights_file = weights_file
+    predictor.mmap_weights = use_mmap
+    if warm_up:
+        predictor.warm_up()
+    else:
+        predictor.load_model()
+    barrier.wait()  # all workers hold their weights -> shared pages are accounted to every worker
+    queue.put(memory_usage())
+    barrier.wait()
+
+
+def check(weights_file, workers, use_mmap, warm_up=False):
+    # memory per worker process with the weights loaded at the same time
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(workers)
+    queue = context.Queue()
+    processes = [context.Process(target=worker, args=(weights_file, use_mmap, warm_up, barrier, queue)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    usage = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return usage
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Prepare memory mapped CNN weights and check memory of predictor processes")
+    parser.add_argument("weights", nargs="?", default=None, help="training checkpoint (default: weights of the predictor)")
+    parser.add_argument("--output", default=None, help="prepared weights (default: <weights>.mmap)")
+    parser.add_argument("--check", type=int, default=0, metavar="WORKERS", help="start this many predictor processes and report their memory")
+    parser.add_argument("--warm-up", action="store_true", help="run the warm-up forward pass in every worker before measuring")
+    args = parser.parse_args()
+
+    weights_file = args.weights if args.weights else SegmentationPredictor().weights_file
+    if not args.check:
+        path = convert_checkpoint(weights_file, args.output)
+        print("Saved", path, "(%.1f MB, checkpoint %.1f MB)" % (os.path.getsize(path) / 1024**2, os.path.getsize(weights_file) / 1024**2))
+    else:
+        mmap_file = mmap_weights_path(weights_file)
+        if not os.path.exists(mmap_file) or load_mmap_weights(mmap_file, file_sha256(weights_file)) is None:
+            print("Converting", weights_file, "first")
+            convert_checkpoint(weights_file)
+        for use_mmap in (False, True):
+            usage = check(weights_file, args.check, use_mmap, args.warm_up)
+            print("%s weights, %d workers:" % ("memory mapped" if use_mmap else "private", args.check))
+            for i, u in enumerate(usage):
+                print("  worker %d: RSS %7.1f MB, PSS %7.1f MB, shared %7.1f MB" % (i, u['rss'] / 1024**2, u['pss'] / 1024**2, u['shared'] / 1024**2))
+            print("  total PSS %.1f MB" % (sum(u['pss'] for u in usage) / 1024**2))
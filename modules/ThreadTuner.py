@@ -0,0 +1,153 @@
+import glob
+import json
+import multiprocessing
+import os
+import socket
+import time
+
+# internal imports
+from defaults import *
+
+# benchmarks the RUNet forward pass for torch thread counts and CPU sets, the fastest configuration is stored per host
+# and applied by SegmentationPredictor on creation: python -m modules.ThreadTuner [--shape 128 128 128]
+
+
+def config_file():
+    return os.path.expanduser(THREAD_CONFIG_FILE)
+
+
+def load_config(host=None):
+    # tuned configuration of this host or None
+    host = socket.gethostname() if host is None else host
+    try:
+        with open(config_file()) as f:
+            return json.load(f).get(host)
+    except (OSError, ValueError):
+        return None
+
+
+def save_config(config, host=None):
+    host = socket.gethostname() if host is None else host
+    path = config_file()
+    try:
+        with open(path) as f:
+            configs = json.load(f)
+    except (OSError, ValueError):
+        configs = {}
+    configs[host] = config
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(configs, f, indent=2)
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def sockets():
+    # cpu ids per physical package (linux), empty list if the topology is unknown
+    packages = {}
+    cpus = set(available_cpus())
+    for path in glob.glob("/sys/devices/system/cpu/cpu[0-9]*/topology/physical_package_id"):
+        cpu = int(path.split("/")[-3][3:])
+        if cpu in cpus:
+            with open(path) as f:
+                packages.setdefault(int(f.read()), []).append(cpu)
+    return [sorted(package) for _, package in sorted(packages.items())]
+
+
+def candidate_affinities():
+    # None: no pinning; one entry per socket on multi-socket machines; all but the first cpu (left to GUI and VTK rendering)
+    cpus = available_cpus()
+    candidates = [None]
+    if not hasattr(os, 'sched_setaffinity'):
+        return candidates
+    packages = sockets()
+    if len(packages) > 1:
+        candidates += packages
+    if len(cpus) > 2:
+        candidates.append(cpus[1:])
+    return candidates
+
+
+def candidate_configs(interop_threads=(1,)):
+    configs = []
+    for affinity in candidate_affinities():
+        cpus = len(affinity) if affinity is not None else len(available_cpus())
+        threads = sorted(set([2**i for i in range(cpus.bit_length()) if 2**i <= cpus] + [cpus]))
+        for num_threads in threads:
+            for num_interop_threads in interop_threads:
+                configs.append({'num_threads': num_threads, 'num_interop_threads': num_interop_threads, 'cpu_affinity': affinity})
+    return configs
+
+
+def set_thread_counts(config):
+    # process wide, the cpu affinity is applied per prediction thread (pin_thread)
+    import torch
+    if config.get('num_threads'):
+        torch.set_num_threads(config['num_threads'])
+    if config.get('num_interop_threads'):
+        try:
+            torch.set_num_interop_threads(config['num_interop_threads'])
+        except RuntimeError:
+            pass  # can only be set once and before any parallel work
+
+
+def pin_thread(cpu_affinity):
+    # restrict the calling thread (and the thread pools it starts) to the given cpus
+    if cpu_affinity and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_affinity)
+
+
+def benchmark(config, input_shape, repeats, queue):
+    # runs in a fresh process, the interop thread count can only be set once per process
+    import torch
+    from modules.Predictor import SegmentationPredictor
+    set_thread_counts(config)  # before the predictor applies a stored configuration, interop threads are fixed by the first call
+    predictor = SegmentationPredictor()
+    predictor.device = 'cpu'
+    predictor.configure_threads(config)
+    predictor.pin_thread()
+    model = predictor.load_model()
+    input_tc = torch.zeros((1, 1, *input_shape))
+    times = []
+    with torch.set_grad_enabled(False):
+        model(input_tc)  # one-time initialization
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(input_tc)
+            times.append(time.perf_counter() - start)
+    queue.put(min(times))
+
+
+def autotune(input_shape=(128, 128, 128), repeats=3, interop_threads=(1,), verbose=True):
+    # fastest configuration of all candidates, result includes the measured forward time
+    context = multiprocessing.get_context('spawn')
+    best = None
+    for config in candidate_configs(interop_threads):
+        queue = context.Queue()
+        process = context.Process(target=benchmark, args=(config, input_shape, repeats, queue))
+        process.start()
+        duration = queue.get()
+        process.join()
+        if verbose:
+            print("threads %3d, interop %2d, cpus %4s: %.3fs" % (config['num_threads'], config['num_interop_threads'], "all" if config['cpu_affinity'] is None else str(len(config['cpu_affinity'])), duration))
+        if best is None or duration < best['time']:
+            best = dict(config, time=duration, input_shape=list(input_shape))
+    return best
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Find the fastest torch thread configuration for CNN inference on this host")
+    parser.add_argument("--shape", nargs=3, type=int, default=[128, 128, 128], help="spatial input shape of the benchmark forward pass")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--interop", nargs="+", type=int, default=[1], help="inter-op thread counts to try")
+    args = parser.parse_args()
+
+    best = autotune(tuple(args.shape), args.repeats, tuple(args.interop))
+    save_config(best)
+    print("Saved", best, "for host", socket.gethostname(), "to", config_file())